@@ -0,0 +1,396 @@
+"""
+Offline load test for main.py. Drives the real command handlers (start, join, play/playlikes,
+guess, end) for N guilds x M players against fake Discord channels and a local stand-in for
+the Spotify Web API, then reports pool-build latency, loop lag, round timing, message
+throughput and memory. Nothing leaves the machine.
+
+    python bench.py --guilds 50 --players 6 --rounds 5 --spotify-latency 0.08 --rate-429 0.02
+"""
+import os
+import sys
+import argparse
+import asyncio
+import json
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+# main.py reads its configuration at import time. Never point a benchmark at the real token database.
+BENCH_DIR = tempfile.mkdtemp(prefix="squiddygame-bench-")
+os.environ["TOKEN_DB_PATH"] = os.path.join(BENCH_DIR, "bench.db")
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "bench")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "bench")
+
+import discord
+from aiohttp import web
+
+import main
+
+GUILD_ID_BASE = 10 ** 17
+USER_ID_BASE = 2 * 10 ** 17
+GAME_POLL_INTERVAL = 0.2  # seconds between checks for a finished game
+
+# ----- STAND-IN SPOTIFY WEB API -----
+class StandInSpotify:
+    """
+    Serves the Web API endpoints the bot reads, on its own thread and event loop so the stand-in's
+    work never shows up as lag on the bot's loop. Every user's library is a fixed sample of one
+    shared catalog, so players' tracks overlap the way real libraries do.
+    """
+    def __init__(self, latency, jitter, rate_429, retry_after, library_size, catalog_size, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.library_size = library_size
+        self.catalog_size = catalog_size
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.libraries = {}  # { access_token: [catalog index] }
+        self.requests = 0
+        self.rate_limited = 0
+        self.url = None
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def library(self, access_token):
+        library = self.libraries.get(access_token)
+        if library is None:
+            rng = random.Random(f"{self.seed}:{access_token}")
+            library = self.libraries[access_token] = rng.sample(range(self.catalog_size), min(self.library_size, self.catalog_size))
+        return library
+
+    @staticmethod
+    def track(index):
+        return {
+            "id": f"bench{index:07d}",
+            "name": f"Track {index}",
+            "artists": [{"name": f"Artist {index % 997}"}],
+            "album": {"images": [{"url": f"https://example.invalid/covers/{index}.jpg"}]},
+            "preview_url": None
+        }
+
+    async def _respond(self, request, build_body):
+        self.requests += 1
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)))
+        if self.rng.random() < self.rate_429:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                status=429, headers={"Retry-After": str(self.retry_after)}
+            )
+        access_token = request.headers.get("Authorization", "").split(" ")[-1]
+        return web.json_response(build_body(self.library(access_token), request.query))
+
+    async def recently_played(self, request):
+        def build_body(library, query):
+            if query.get("after"):
+                return {"items": [], "cursors": None, "limit": int(query.get("limit", 20))}  # nothing new since the last sync
+            items = [{"track": self.track(index), "played_at": "2024-01-01T00:00:00Z"} for index in library[:int(query.get("limit", 20))]]
+            return {"items": items, "cursors": {"after": str(int(time.time() * 1000)), "before": "0"}}
+        return await self._respond(request, build_body)
+
+    async def saved_tracks(self, request):
+        def build_body(library, query):
+            offset, limit = int(query.get("offset", 0)), int(query.get("limit", 20))
+            items = [{"track": self.track(index), "added_at": "2024-01-01T00:00:00Z"} for index in library[offset:offset + limit]]
+            return {"items": items, "total": len(library), "offset": offset, "limit": limit}
+        return await self._respond(request, build_body)
+
+    def start(self):
+        ready = threading.Event()
+
+        async def serve():
+            app = web.Application()
+            app.router.add_get("/v1/me/player/recently-played", self.recently_played)
+            app.router.add_get("/v1/me/tracks", self.saved_tracks)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://127.0.0.1:{port}/v1/"
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(serve())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="stand-in-spotify", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+# ----- FAKE DISCORD -----
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+        self.display_name = f"player{user_id - USER_ID_BASE}"
+
+    async def send(self, *args, **kwargs):
+        pass  # the Spotify authorization DM
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+
+class FakeChannel:
+    """
+    Records every message, waits out a simulated Discord latency, and tells its guild's
+    driver when a round embed goes out so the players can guess.
+    """
+    def __init__(self, bench, driver, channel_id):
+        self.bench = bench
+        self.driver = driver
+        self.id = channel_id
+        self.guild = driver.guild
+
+    async def send(self, content=None, *, embed=None, view=None, **kwargs):
+        await asyncio.sleep(self.bench.discord_latency)
+        self.bench.messages += 1
+        if embed is not None and embed.title.startswith("Guess Round"):
+            self.driver.on_round()
+        return FakeMessage(self)
+
+class FakeContext:
+    def __init__(self, channel, author):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.interaction = None  # prefix invocation
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def defer(self, **kwargs):
+        pass
+
+# ----- BENCHMARK -----
+class GuildDriver:
+    """
+    Plays one guild's game from !start to the end, with every player guessing at a random
+    moment in each round.
+    """
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.guild = FakeGuild(GUILD_ID_BASE + index)
+        self.channel = FakeChannel(bench, self, GUILD_ID_BASE + index)
+        self.players = [FakeUser(USER_ID_BASE + index * bench.args.players + n) for n in range(bench.args.players)]
+        self.rng = random.Random(f"{bench.args.seed}:{index}")
+        self._guesses = set()
+
+    def ctx(self, user):
+        return FakeContext(self.channel, user)
+
+    def on_round(self):
+        self.bench.rounds_started += 1
+        for player in self.players:
+            task = asyncio.get_running_loop().create_task(self.guess(player))
+            self._guesses.add(task)
+            task.add_done_callback(self._guesses.discard)
+
+    async def guess(self, player):
+        await asyncio.sleep(self.rng.uniform(0, self.bench.args.round_length * self.bench.args.guess_window))
+        target = self.rng.choice(self.players)
+        await main.guess.callback(self.ctx(player), discord.Object(target.id))
+        self.bench.guesses += 1
+
+    async def run(self):
+        args = self.bench.args
+        host = self.players[0]
+        await main.start.callback(self.ctx(host))
+        # Set directly: the benchmark wants rounds shorter than !settings allows
+        main.update_guild_settings(
+            self.guild.id, rounds=args.rounds, round_length=args.round_length, fast_mode=args.fast_mode, grace=None
+        )
+        for player in self.players:
+            await main.join.callback(self.ctx(player))
+
+        command = main.playlikes if args.liked else main.play
+        started = time.perf_counter()
+        await command.callback(self.ctx(host))
+        self.bench.play_latency.observe(time.perf_counter() - started)
+
+        # status goes False before the scoreboard is out; the game is only over once
+        # announce_winner_and_reset has sent it and discarded the session
+        while True:
+            game_state = main.game_registry.games.get(self.channel.id)
+            if game_state is None:
+                break
+            if args.end_after and game_state.status and game_state.current_round >= args.end_after:
+                await main.end.callback(self.ctx(host))
+                continue
+            await asyncio.sleep(GAME_POLL_INTERVAL)
+        # A guess still waiting would land after the game and open a fresh session
+        for task in list(self._guesses):
+            task.cancel()
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.discord_latency = args.discord_latency
+        self.messages = 0
+        self.rounds_started = 0
+        self.guesses = 0
+        self.play_latency = main.Histogram()
+
+    def store_tokens(self, drivers):
+        expires_at = int(time.time()) + 86400
+        for driver in drivers:
+            for player in driver.players:
+                main.token_store.set(player.id, {
+                    "access_token": f"bench-{player.id}",
+                    "token_type": "Bearer",
+                    "expires_in": 3600,
+                    "refresh_token": "bench",
+                    "scope": main.SCOPES,
+                    "expires_at": expires_at
+                })
+
+    async def run(self):
+        args = self.args
+        main.bot.loop = asyncio.get_running_loop()
+        drivers = [GuildDriver(self, index) for index in range(args.guilds)]
+        channels = {driver.channel.id: driver.channel for driver in drivers}
+        main.bot.get_channel = channels.get
+        self.store_tokens(drivers)
+
+        main.monitor_loop_lag.start()
+        main.checkpoint_games.start()
+        started = time.perf_counter()
+        try:
+            runs = []
+            for driver in drivers:
+                runs.append(asyncio.get_running_loop().create_task(driver.run()))
+                if args.stagger:
+                    await asyncio.sleep(args.stagger)
+            results = await asyncio.gather(*runs, return_exceptions=True)
+        finally:
+            elapsed = time.perf_counter() - started
+            main.monitor_loop_lag.cancel()
+            main.checkpoint_games.cancel()
+            await main.flush_checkpoints()
+
+        failures = [result for result in results if isinstance(result, Exception)]
+        for failure in failures[:5]:
+            print(f"DEBUG: Guild driver failed: {failure!r}")
+        return elapsed, len(failures)
+
+def build_report(args, bench, spotify, elapsed, failures):
+    histograms = main.metrics.report()
+    return {
+        "config": vars(args),
+        "wall_time": round(elapsed, 2),
+        "failed_guilds": failures,
+        "rounds_started": bench.rounds_started,
+        "guesses": bench.guesses,
+        "messages": bench.messages,
+        "messages_per_second": round(bench.messages / elapsed, 1) if elapsed else 0.0,
+        "play_command": bench.play_latency.snapshot(),
+        "pool_build": histograms.get("game.pool_build", {"count": 0}),
+        "loop_lag": histograms.get("loop.lag", {"count": 0}),
+        "round_drift": histograms.get("round.drift", {"count": 0}),
+        "discord_send": histograms.get("discord.send", {"count": 0}),
+        "spotify": {
+            "server_requests": spotify.requests,
+            "server_429s": spotify.rate_limited,
+            "scheduler": main.spotify_scheduler.report(),
+            "endpoints": {name: snapshot for name, snapshot in histograms.items() if name.startswith("spotify.")}
+        },
+        "memory": {
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            **main.memory_report()
+        }
+    }
+
+def print_report(report):
+    def latency(snapshot):
+        if not snapshot.get("count"):
+            return "no samples"
+        return (
+            f"n={snapshot['count']} mean={snapshot['mean_ms']}ms p50={snapshot['p50_ms']}ms "
+            f"p90={snapshot['p90_ms']}ms p99={snapshot['p99_ms']}ms max={snapshot['max_ms']}ms"
+        )
+
+    config = report["config"]
+    print(
+        f"{config['guilds']} guilds x {config['players']} players, {config['rounds']} rounds of {config['round_length']}s "
+        f"({'liked songs' if config['liked'] else 'recently played'}{', fast mode' if config['fast_mode'] else ''})"
+    )
+    print(f"wall time:        {report['wall_time']}s, {report['failed_guilds']} failed guilds")
+    print(f"rounds / guesses: {report['rounds_started']} / {report['guesses']}")
+    print(f"!play command:    {latency(report['play_command'])}")
+    print(f"pool build:       {latency(report['pool_build'])}")
+    print(f"loop lag:         {latency(report['loop_lag'])}")
+    print(f"round drift:      {latency(report['round_drift'])}")
+    print(f"discord send:     {latency(report['discord_send'])}")
+    print(f"messages:         {report['messages']} ({report['messages_per_second']}/s)")
+    spotify = report["spotify"]
+    print(
+        f"spotify:          {spotify['server_requests']} requests, {spotify['server_429s']} answered 429, "
+        f"{spotify['scheduler']['coalesced']} coalesced"
+    )
+    for name, snapshot in spotify["endpoints"].items():
+        print(f"  {name}: {latency(snapshot)}")
+    print("memory:           " + ", ".join(f"{key}={value}" for key, value in report["memory"].items()))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offline load test for the Spotify guessing game bot.")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--players", type=int, default=5, help="players per guild")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--round-length", type=float, default=1.0, help="seconds per round")
+    parser.add_argument("--fast-mode", action="store_true", help="end rounds once everyone has guessed")
+    parser.add_argument("--guess-window", type=float, default=0.8, help="fraction of the round players guess within")
+    parser.add_argument("--end-after", type=int, default=0, help="!end each game after this many rounds (0: play them all)")
+    parser.add_argument("--liked", action="store_true", help="use !playlikes instead of !play")
+    parser.add_argument("--stagger", type=float, default=0.0, help="seconds between guild starts")
+    parser.add_argument("--spotify-latency", type=float, default=0.05, help="mean stand-in Spotify latency, seconds")
+    parser.add_argument("--spotify-jitter", type=float, default=0.02)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of Spotify requests answered 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--library-size", type=int, default=400, help="tracks in each player's library")
+    parser.add_argument("--catalog-size", type=int, default=20000, help="distinct tracks libraries are drawn from")
+    parser.add_argument("--discord-latency", type=float, default=0.03, help="simulated seconds per Discord send")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+def run(argv=None):
+    args = parse_args(argv)
+    spotify = StandInSpotify(
+        args.spotify_latency, args.spotify_jitter, args.rate_429, args.retry_after,
+        args.library_size, args.catalog_size, args.seed
+    )
+    spotify.start()
+    main.SPOTIFY_API_URL = spotify.url
+    try:
+        bench = Bench(args)
+        elapsed, failures = asyncio.run(bench.run())
+    finally:
+        spotify.stop()
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    report = build_report(args, bench, spotify, elapsed, failures)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(run())
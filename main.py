@@ -1,14 +1,32 @@
+import time
+PROCESS_STARTED = time.perf_counter()  # before the imports below, so startup timings include them
+
 import os
+import sys
 import random
 import asyncio
+import functools
+import json
+import signal
+import sqlite3
+import threading
+import heapq
+import itertools
+import subprocess
+import bisect
+import io
+import shutil
+import zlib
 import discord
-from discord.ext import commands
-
-from flask import Flask, request
-from threading import Thread
+from abc import ABC, abstractmethod
+from discord.ext import commands, tasks
 
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+from aiohttp import web
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+# spotipy and requests are imported on first use (warm_spotify_imports() does it in the
+# background at startup), so they stay off the cold-start path
 
 # Environment variables in Replit secrets:
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
@@ -19,181 +37,2494 @@ DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 BOT_PREFIX = '!'
 REDIRECT_URI = "https://web-production-b04e.up.railway.app/callback"
 SCOPES = "user-read-recently-played user-library-read"
+DEFAULT_ROUNDS = 20
+DEFAULT_ROUND_LENGTH = 10  # seconds
+MAX_ROUNDS = 50
+ROUND_LENGTH_RANGE = (5, 120)
+
+# Sharding: SHARD_COUNT gateway shards in total, of which this process runs SHARD_IDS
+# (comma-separated; all of them by default). With SHARD_PROCESSES > 1, main.py becomes a
+# supervisor that splits the shards across that many child processes.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()] or list(range(SHARD_COUNT))
+SHARD_PROCESSES = int(os.getenv("SHARD_PROCESSES", 1))
+SHARD_SUPERVISOR_POLL_INTERVAL = 1.0  # seconds between the supervisor's checks on its shard processes
+SHARD_STOP_TIMEOUT = 30  # seconds a shard process gets to checkpoint and exit before it's killed
+# The primary process serves the OAuth web server, syncs slash commands and refreshes tokens
+PRIMARY_PROCESS = os.getenv("PRIMARY_PROCESS", "1") == "1"
 
 # ----- MULTI-SERVER GAME STATES -----
-active_games = {}  # { guild_id: { ...gameState... } }
+# A game session belongs to the channel or thread it was started in, so one guild can run
+# several games side by side. Settings are still per guild.
+STATE_IDLE_TTL = int(os.getenv("STATE_IDLE_TTL", 3600))  # seconds before an idle session or join entry is dropped
+STATE_SWEEP_INTERVAL = 300                                # seconds between idle-state sweeps
+
+class GameState:
+    """
+    One channel's game. Slots keep the per-session footprint small when thousands are loaded.
+    """
+    __slots__ = (
+        "status", "players", "player_names", "track_pool", "current_round", "round_in_progress",
+        "round_guesses", "points", "rounds", "round_length", "fast_mode", "grace", "guess_options",
+        "round_plan", "voice", "channel_id", "guild_id", "building", "last_active", "dirty", "generation"
+    )
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.status = False
+        self.players = set()
+        self.player_names = {}     # { user_id: display name at !join }
+        self.track_pool = TrackPool()
+        self.current_round = 0
+        self.round_in_progress = False
+        self.round_guesses = {}    # { guesser_id: guessed_user_id }
+        self.points = {}           # { user_id: points }
+        # Copied from the guild's settings at !play
+        self.rounds = DEFAULT_ROUNDS
+        self.round_length = DEFAULT_ROUND_LENGTH
+        self.fast_mode = False
+        self.grace = None
+        self.guess_options = None
+        self.round_plan = []       # [ PlannedRound ], pre-rendered at !play
+        self.voice = None          # VoiceClient playing previews, in voice preview mode
+        self.channel_id = None     # where the game is played; the session's key
+        self.guild_id = None
+        self.building = False      # a !play is gathering the track pool
+        self.dirty = False         # changed since the last checkpoint
+        self.generation = 0        # bumped by every !play, so a superseded round chain stops
+        self.touch()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def to_dict(self):
+        return {
+            "channel_id": self.channel_id,
+            "players": sorted(self.players),
+            "player_names": self.player_names,
+            "track_pool": self.track_pool.to_dict(),
+            "current_round": self.current_round,
+            "round_in_progress": self.round_in_progress,
+            "round_guesses": self.round_guesses,
+            "points": self.points,
+            "rounds": self.rounds,
+            "round_length": self.round_length,
+            "fast_mode": self.fast_mode,
+            "grace": self.grace,
+            "guess_menu": self.guess_options is not None
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        game_state = cls()
+        game_state.status = True
+        game_state.channel_id = data["channel_id"]
+        game_state.players = set(data["players"])
+        game_state.player_names = data["player_names"]
+        game_state.track_pool = TrackPool.from_dict(data["track_pool"])
+        game_state.current_round = data["current_round"]
+        game_state.round_in_progress = data["round_in_progress"]
+        game_state.round_guesses = data["round_guesses"]
+        game_state.points = data["points"]
+        game_state.rounds = data["rounds"]
+        game_state.round_length = data["round_length"]
+        game_state.fast_mode = data["fast_mode"]
+        game_state.grace = data["grace"]
+        game_state.guess_options = build_guess_options(game_state) if data["guess_menu"] else None
+        game_state.round_plan = render_rounds(game_state)
+        return game_state
+
+class GameRegistry:
+    """
+    GameState per channel, plus an index from each player to the channels of the sessions
+    they've joined. sweep() drops sessions with no game activity for ttl seconds, so a
+    long-running process stays flat.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.games = {}            # { channel_id: GameState }
+        self.player_sessions = {}  # { user_id: { channel_id, ... } }
+
+    def get(self, channel_id):
+        game_state = self.games.get(channel_id)
+        if game_state is None:
+            game_state = self.games[channel_id] = GameState()
+        game_state.touch()
+        return game_state
+
+    def add(self, channel_id, game_state):
+        """
+        Registers a restored session and indexes its players.
+        """
+        self.games[channel_id] = game_state
+        for player_id in game_state.players:
+            self.index_player(player_id, channel_id)
+
+    def index_player(self, user_id, channel_id):
+        self.player_sessions.setdefault(user_id, set()).add(channel_id)
+
+    def is_live(self, game_state, generation=None):
+        """
+        Whether game_state is still its channel's running game, i.e. nobody ended or
+        restarted it while we were awaiting something. With a generation, also whether
+        no later !play has replanned its rounds since.
+        """
+        return (
+            game_state.status and self.games.get(game_state.channel_id) is game_state
+            and (generation is None or game_state.generation == generation)
+        )
+
+    def sessions_of(self, user_id):
+        """
+        Channel IDs of the sessions the user has joined.
+        """
+        return self.player_sessions.get(user_id, ())
+
+    def discard(self, channel_id):
+        game_state = self.games.pop(channel_id, None)
+        if game_state is None:
+            return
+        for player_id in game_state.players:
+            sessions = self.player_sessions.get(player_id)
+            if sessions is not None:
+                sessions.discard(channel_id)
+                if not sessions:
+                    del self.player_sessions[player_id]
+
+    def sweep(self):
+        """
+        Evicts idle sessions. Commands, guesses and round changes all mark a session active,
+        and a session with a round underway is never evicted.
+        Returns the number of sessions evicted.
+        """
+        cutoff = time.monotonic() - self.ttl
+        idle_sessions = [
+            channel_id for channel_id, game_state in self.games.items()
+            if game_state.last_active < cutoff and not game_state.round_in_progress
+            and round_scheduler.remaining(channel_id) is None
+        ]
+        for channel_id in idle_sessions:
+            self.discard(channel_id)
+        return len(idle_sessions)
+
+    def memory_report(self):
+        """
+        Counts and shallow size estimates (bytes) for the registry's contents.
+        """
+        game_bytes = sum(
+            sys.getsizeof(game_state) + sys.getsizeof(game_state.players) + sys.getsizeof(game_state.player_names)
+            + sys.getsizeof(game_state.round_guesses) + sys.getsizeof(game_state.points)
+            + sys.getsizeof(game_state.track_pool.tracks) + sys.getsizeof(game_state.track_pool.order)
+            for game_state in self.games.values()
+        )
+        return {
+            "sessions": len(self.games),
+            "active_games": sum(1 for game_state in self.games.values() if game_state.status),
+            "game_state_bytes": game_bytes,
+            "indexed_players": len(self.player_sessions)
+        }
+
+game_registry = GameRegistry(STATE_IDLE_TTL)
 
 def get_game_state(ctx):
     """
-    Returns the game state dict for this server/guild.
+    Returns the GameState for this channel's session (ctx can be a Context or a channel).
     If none exists, creates one.
     """
-    guild_id = ctx.guild.id
-    if guild_id not in active_games:
-        active_games[guild_id] = {
-            "status": False,
-            "players": set(),
-            "track_pool": [],
-            "current_round": 0,
-            "round_in_progress": False,
-            "round_guesses": {},
-            "points": {},
-            "round_task": None  # <--- We'll store the running round's Task here
+    return game_registry.get(getattr(ctx, "channel", ctx).id)
+
+DEFAULT_GUILD_SETTINGS = MappingProxyType({
+    "rounds": DEFAULT_ROUNDS,
+    "round_length": DEFAULT_ROUND_LENGTH,
+    "fast_mode": False,  # close a round as soon as every player has guessed
+    "grace": None,       # with fast_mode, seconds left to guess once the first guess is in
+    "guess_menu": False,  # attach a player menu to each round embed
+    "voice_preview": False  # play each track's preview in the !play invoker's voice channel
+})
+
+def get_guild_settings(guild_id):
+    """
+    Returns this guild's round settings, read-only. Guilds that never changed one share the defaults.
+    """
+    return guild_settings.get(guild_id, DEFAULT_GUILD_SETTINGS)
+
+def update_guild_settings(guild_id, **changes):
+    """
+    Changes some of this guild's settings, giving it its own entry on the first change.
+    """
+    guild_config = guild_settings.setdefault(guild_id, dict(DEFAULT_GUILD_SETTINGS))
+    guild_config.update(changes)
+    return guild_config
+
+guild_settings = {}  # { guild_id: { ...settings... } }, only for guilds that changed a setting
+
+# ----- SPOTIFY TOKEN STORE -----
+TOKEN_DB_PATH = os.getenv("TOKEN_DB_PATH", "squiddygame.db")
+TOKEN_REFRESH_INTERVAL = 60  # seconds between refresh scheduler passes
+TOKEN_REFRESH_MARGIN = 300   # refresh tokens this many seconds before they expire
+TOKEN_REFRESH_BATCH = 100    # most tokens refreshed per pass; the rest wait for the next one
+TOKEN_REFRESH_CONCURRENCY = 4
+
+def connect_db(path):
+    """
+    Opens the bot's SQLite file. WAL lets shard processes read while another one writes.
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+class TokenStore:
+    """
+    Spotify token_info dicts keyed by Discord user ID, persisted to SQLite so they survive restarts.
+    Reads are served from an in-memory cache; writes go to the database first, then the cache.
+    Other shard processes write to the same file, so a missing or nearly expired entry is re-read.
+    The full table is only read by load(), which startup runs off the event loop.
+    _lock guards the connection and is held across database I/O; _cache_lock only ever guards
+    the cache, so the event loop can scan it without waiting on another process's commit.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._conn = connect_db(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS spotify_tokens (user_id TEXT PRIMARY KEY, token_info TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self._cache = {}
+        self.loaded = False
+
+    def load(self):
+        """
+        Reads every stored token into the cache, for the refresh scheduler. Blocking.
+        """
+        with self._lock:
+            rows = [
+                (user_id, json.loads(token_info))
+                for user_id, token_info in self._conn.execute("SELECT user_id, token_info FROM spotify_tokens")
+            ]
+            with self._cache_lock:
+                for user_id, token_info in rows:
+                    self._cache.setdefault(user_id, token_info)
+            self.loaded = True
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        token_info = self._cache.get(user_id)
+        if token_info is not None and token_info.get("expires_at", 0) > time.time() + TOKEN_REFRESH_MARGIN:
+            return token_info
+
+        with self._lock:
+            row = self._conn.execute("SELECT token_info FROM spotify_tokens WHERE user_id = ?", (user_id,)).fetchone()
+            with self._cache_lock:
+                if row is None:
+                    self._cache.pop(user_id, None)
+                    return None
+                token_info = self._cache[user_id] = json.loads(row[0])
+        return token_info
+
+    def set(self, user_id, token_info):
+        user_id = str(user_id)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO spotify_tokens (user_id, token_info) VALUES (?, ?)",
+                (user_id, json.dumps(token_info))
+            )
+            self._conn.commit()
+            with self._cache_lock:
+                self._cache[user_id] = token_info
+
+    def delete(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            self._conn.execute("DELETE FROM spotify_tokens WHERE user_id = ?", (user_id,))
+            self._conn.commit()
+            with self._cache_lock:
+                self._cache.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def expiring_before(self, timestamp):
+        """
+        Returns the user IDs whose access token expires before the given Unix timestamp, soonest first.
+        Only reads the cache, so it's safe to call from the event loop.
+        """
+        with self._cache_lock:
+            expiring = [
+                (token_info.get("expires_at", 0), user_id) for user_id, token_info in self._cache.items()
+                if token_info.get("expires_at", 0) < timestamp
+            ]
+        return [user_id for _expires_at, user_id in sorted(expiring)]
+
+# ----- SHARED STATE -----
+# State every shard process needs to see: Spotify tokens, the guilds/channels each user
+# joined games in, and events the OAuth callback routes to the process that owns a guild's shard.
+SHARD_EVENT_POLL_INTERVAL = 1.0  # seconds between polls for events routed to this process
+
+def shard_of(guild_id):
+    """
+    The gateway shard Discord assigns this guild to.
+    """
+    return (guild_id >> 22) % SHARD_COUNT
+
+def owns_guild(guild_id):
+    return shard_of(guild_id) in SHARD_IDS
+
+class SharedState(ABC):
+    """
+    Interface for the state shared across shard processes. The join and event methods block,
+    so call them from a worker thread. A subclass missing any of them can't be instantiated.
+    """
+    @property
+    @abstractmethod
+    def tokens(self):
+        """
+        A TokenStore-like object.
+        """
+
+    @abstractmethod
+    def record_join(self, user_id, guild_id, channel_id):
+        """
+        Remembers that the user joined a game in the guild's channel.
+        """
+
+    @abstractmethod
+    def join_guilds(self, user_id):
+        """
+        Returns the IDs of the guilds the user has recently joined a game in.
+        """
+
+    @abstractmethod
+    def recent_joiners(self):
+        """
+        Returns the IDs of the users with a join entry, i.e. who joined a game within STATE_IDLE_TTL.
+        """
+
+    @abstractmethod
+    def forget_joins_before(self, timestamp):
+        """
+        Drops join entries older than the given Unix timestamp. Returns how many were dropped.
+        """
+
+    @abstractmethod
+    def post_event(self, shard_id, kind, payload):
+        """
+        Queues an event for the process that runs shard_id.
+        """
+
+    @abstractmethod
+    def take_events(self, shard_ids):
+        """
+        Removes and returns [(kind, payload)] posted to any of shard_ids, oldest first.
+        """
+
+class SQLiteSharedState(SharedState):
+    """
+    SharedState in a local SQLite file, for shard processes running on one host.
+    """
+    def __init__(self, path):
+        self._tokens = TokenStore(path)
+        self._lock = threading.Lock()
+        self._conn = connect_db(path)
+        # One row per (user, channel) now that a user can be in several games; the old
+        # one-row-per-user table only held entries for STATE_IDLE_TTL, so it's just dropped
+        self._conn.execute("DROP TABLE IF EXISTS join_routes")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_joins (user_id TEXT NOT NULL, guild_id INTEGER NOT NULL, "
+            "channel_id INTEGER NOT NULL, joined_at REAL NOT NULL, PRIMARY KEY (user_id, channel_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shard_events "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, shard_id INTEGER NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS shard_events_by_shard ON shard_events (shard_id, id)")
+        self._conn.commit()
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def record_join(self, user_id, guild_id, channel_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_joins (user_id, guild_id, channel_id, joined_at) VALUES (?, ?, ?, ?)",
+                (str(user_id), guild_id, channel_id, time.time())
+            )
+            self._conn.commit()
+
+    def join_guilds(self, user_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT guild_id FROM user_joins WHERE user_id = ?", (str(user_id),)
+            ).fetchall()
+        return [guild_id for (guild_id,) in rows]
+
+    def recent_joiners(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT user_id FROM user_joins").fetchall()
+        return [user_id for (user_id,) in rows]
+
+    def forget_joins_before(self, timestamp):
+        with self._lock:
+            dropped = self._conn.execute("DELETE FROM user_joins WHERE joined_at < ?", (timestamp,)).rowcount
+            self._conn.commit()
+        return dropped
+
+    def post_event(self, shard_id, kind, payload):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO shard_events (shard_id, kind, payload) VALUES (?, ?, ?)",
+                (shard_id, kind, json.dumps(payload))
+            )
+            self._conn.commit()
+
+    def take_events(self, shard_ids):
+        marks = ",".join("?" * len(shard_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, kind, payload FROM shard_events WHERE shard_id IN ({marks}) ORDER BY id", shard_ids
+            ).fetchall()
+            if rows:
+                self._conn.executemany("DELETE FROM shard_events WHERE id = ?", [(row[0],) for row in rows])
+                self._conn.commit()
+        return [(kind, json.loads(payload)) for _id, kind, payload in rows]
+
+shared_state = SQLiteSharedState(TOKEN_DB_PATH)
+token_store = shared_state.tokens
+
+# ----- GAME CHECKPOINTS -----
+# Active games are checkpointed to the same SQLite file as the tokens, so a
+# redeploy resumes them where they were instead of dropping them.
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", 5))  # seconds between checkpoint passes
+
+class CheckpointStore:
+    """
+    The latest serialized GameState of each active session, keyed by channel ID.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = connect_db(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_checkpoints "
+            "(channel_id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, state TEXT NOT NULL, saved_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._migrate_guild_checkpoints()
+
+    def _migrate_guild_checkpoints(self):
+        """
+        Moves rows from the per-guild table used before sessions were keyed by channel.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        if self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'game_checkpoints'").fetchone():
+            rows = self._conn.execute("SELECT guild_id, state, saved_at FROM game_checkpoints").fetchall()
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO session_checkpoints (channel_id, guild_id, state, saved_at) VALUES (?, ?, ?, ?)",
+                [(json.loads(state)["channel_id"], guild_id, state, saved_at) for guild_id, state, saved_at in rows]
+            )
+            self._conn.execute("DROP TABLE game_checkpoints")
+        self._conn.commit()
+
+    def save(self, writes, deletes):
+        """
+        Writes [(channel_id, guild_id, state_json)] and removes [channel_id] in one transaction
+        (rolled back if it fails). Blocking.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO session_checkpoints (channel_id, guild_id, state, saved_at) VALUES (?, ?, ?, ?)",
+                [(channel_id, guild_id, state, now) for channel_id, guild_id, state in writes]
+            )
+            self._conn.executemany(
+                "DELETE FROM session_checkpoints WHERE channel_id = ?", [(channel_id,) for channel_id in deletes]
+            )
+
+    def load_all(self, owns=None):
+        """
+        Returns { channel_id: (guild_id, state_json) } for every checkpoint, or only those whose guild
+        owns(guild_id) accepts. States stay undecoded so the caller can skip a bad one.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT channel_id, guild_id, state FROM session_checkpoints").fetchall()
+        return {
+            channel_id: (guild_id, state)
+            for channel_id, guild_id, state in rows if owns is None or owns(guild_id)
         }
-    return active_games[guild_id]
 
-# For each user ID, we store (guild_id, channel_id) to announce "ready" post-auth
-join_channels = {}  # { user_id: (guild_id, channel_id) }
+checkpoint_store = CheckpointStore(TOKEN_DB_PATH)
+checkpointed_sessions = set()  # channels that currently have a row in checkpoint_store
 
-# In-memory storage for user Spotify data
-user_spotify_data = {}
+# ----- LEADERBOARDS -----
+# Finished games add to per-guild and global all-time totals. Results are buffered in
+# memory and written in one batch per flush, and top-K reads walk an index on
+# (guild_id, points), so a big server's leaderboard never scans the table.
+LEADERBOARD_FLUSH_INTERVAL = float(os.getenv("LEADERBOARD_FLUSH_INTERVAL", 30))  # seconds between batch writes
+LEADERBOARD_SIZE = 10
+GLOBAL_LEADERBOARD = 0  # guild_id of the rows that total every guild
+
+class LeaderboardStore:
+    """
+    All-time points, games played and wins per (guild_id, user_id), plus buffered results
+    not yet written. The buffer is only touched from the event loop; write() and top() block.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = connect_db(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leaderboard (guild_id INTEGER NOT NULL, user_id TEXT NOT NULL, "
+            "points INTEGER NOT NULL, games INTEGER NOT NULL, wins INTEGER NOT NULL, PRIMARY KEY (guild_id, user_id))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS leaderboard_top ON leaderboard (guild_id, points DESC, wins DESC)"
+        )
+        self._conn.commit()
+        self._pending = {}  # { (guild_id, user_id): [points, games, wins] }
+
+    def record_game(self, guild_id, points, winners):
+        """
+        Buffers one finished game: points per player, and the players who won it.
+        """
+        for user_id, user_points in points.items():
+            self._add(guild_id, user_id, user_points, 1, int(user_id in winners))
+            self._add(GLOBAL_LEADERBOARD, user_id, user_points, 1, int(user_id in winners))
+
+    def _add(self, guild_id, user_id, points, games, wins):
+        entry = self._pending.get((guild_id, user_id))
+        if entry is None:
+            self._pending[(guild_id, user_id)] = [points, games, wins]
+        else:
+            entry[0] += points
+            entry[1] += games
+            entry[2] += wins
+
+    def take_pending(self):
+        """
+        Empties the buffer, returning its rows as [(guild_id, user_id, points, games, wins)].
+        """
+        pending, self._pending = self._pending, {}
+        return [(guild_id, user_id, *totals) for (guild_id, user_id), totals in pending.items()]
+
+    def restore_pending(self, rows):
+        """
+        Puts rows from take_pending() back after a failed write.
+        """
+        for row in rows:
+            self._add(*row)
+
+    def write(self, rows):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO leaderboard (guild_id, user_id, points, games, wins) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (guild_id, user_id) DO UPDATE SET points = points + excluded.points, "
+                "games = games + excluded.games, wins = wins + excluded.wins",
+                rows
+            )
+            self._conn.commit()
+
+    def top(self, guild_id, limit):
+        """
+        Returns [(user_id, points, games, wins)] for the guild's (or GLOBAL_LEADERBOARD's) best players.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT user_id, points, games, wins FROM leaderboard WHERE guild_id = ? "
+                "ORDER BY points DESC, wins DESC LIMIT ?",
+                (guild_id, limit)
+            ).fetchall()
+
+leaderboard_store = LeaderboardStore(TOKEN_DB_PATH)
+leaderboard_flush_lock = asyncio.Lock()
+
+async def flush_leaderboards():
+    """
+    Writes buffered game results in one batch on a worker thread. Returns once everything
+    buffered before the call is in the database.
+    """
+    async with leaderboard_flush_lock:
+        rows = leaderboard_store.take_pending()
+        if not rows:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, leaderboard_store.write, rows)
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error writing {len(rows)} leaderboard rows, keeping them for the next flush: {e}")
+            leaderboard_store.restore_pending(rows)
+
+@tasks.loop(seconds=LEADERBOARD_FLUSH_INTERVAL)
+async def flush_leaderboard_results():
+    await flush_leaderboards()
+
+# ----- SPOTIFY CLIENTS -----
+# Every Spotify request goes through one pooled keep-alive session, so game starts
+# reuse warm connections instead of doing a TLS handshake per player.
+SPOTIFY_MAX_WORKERS = int(os.getenv("SPOTIFY_MAX_WORKERS", 16))
+SPOTIFY_CLIENT_CACHE_SIZE = int(os.getenv("SPOTIFY_CLIENT_CACHE_SIZE", 1000))
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL")  # overrides the Web API base URL, e.g. bench.py's stand-in
+
+@functools.lru_cache(maxsize=None)
+def get_spotify_session():
+    """
+    The requests session shared by every Spotify call, created on first use.
+    """
+    import requests
+    import urllib3
+    import spotipy
+
+    session = requests.Session()
+    # Same retry policy spotipy builds for its own sessions, minus 429: urllib3 would sleep out
+    # Retry-After inside a pool thread, so rate limits are left to spotify_scheduler instead.
+    # Retry-After is ignored outright, since urllib3 otherwise retries 429 even off the forcelist
+    retry = urllib3.Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=[code for code in spotipy.Spotify.default_retry_codes if code != 429],
+        respect_retry_after_header=False
+    )
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=SPOTIFY_MAX_WORKERS, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@functools.lru_cache(maxsize=None)
+def shared_session_spotify_class():
+    import spotipy
+
+    class SharedSessionSpotify(spotipy.Spotify):
+        """
+        spotipy.Spotify closes its session when garbage collected. The session here is
+        shared by every client, so evicting one client must leave it open.
+        """
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            if SPOTIFY_API_URL:
+                self.prefix = SPOTIFY_API_URL
+
+        def __del__(self):
+            pass
+
+    return SharedSessionSpotify
+
+def warm_spotify_imports():
+    """
+    Imports spotipy and builds the shared session ahead of the first game. Blocking.
+    """
+    import spotipy.oauth2
+    get_spotify_session()
+    shared_session_spotify_class()
 
-# ----- FLASK APP FOR SPOTIFY OAUTH -----
-app = Flask(__name__)
-app.secret_key = "some-random-secret-key"
+class SpotifyClientRegistry:
+    """
+    One spotipy client per Discord user, rebuilt only when the user's access token changes.
+    Holds at most max_size clients, evicting the least recently used.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._clients = OrderedDict()  # { user_id: (access_token, client) }
+        self._lock = threading.Lock()  # clients are looked up from the Spotify thread pool
+
+    def get(self, user_id, access_token):
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._clients.get(user_id)
+            if entry is not None and entry[0] == access_token:
+                self._clients.move_to_end(user_id)
+                return entry[1]
+
+            client = shared_session_spotify_class()(auth=access_token, requests_session=get_spotify_session())
+            self._clients[user_id] = (access_token, client)
+            self._clients.move_to_end(user_id)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+            return client
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._clients.pop(str(user_id), None)
+
+    def __len__(self):
+        return len(self._clients)
+
+spotify_clients = SpotifyClientRegistry(SPOTIFY_CLIENT_CACHE_SIZE)
 
 def create_spotify_oauth(state=None):
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+
     return SpotifyOAuth(
         client_id=SPOTIFY_CLIENT_ID,
         client_secret=SPOTIFY_CLIENT_SECRET,
         redirect_uri=REDIRECT_URI,
         scope=SCOPES,
         show_dialog=True,
-        state=state
+        state=state,
+        requests_session=get_spotify_session(),
+        # Tokens live in token_store; don't let spotipy write a shared .cache file
+        cache_handler=spotipy.MemoryCacheHandler()
     )
 
-@app.route("/")
-def index():
-    return "Spotify Guessing Game Bot is running!"
+@functools.lru_cache(maxsize=None)
+def get_spotify_oauth():
+    """
+    The SpotifyOAuth shared by every user; the per-user state is passed to get_authorize_url instead.
+    """
+    return create_spotify_oauth()
+
+# ----- METRICS -----
+# Latency histograms and gauges served as JSON on /metrics, plus a cProfile of the
+# event loop that /debug/profile switches on and off without a redeploy.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # when set, /metrics needs ?token=; /debug/profile always does
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+LOOP_LAG_INTERVAL = 1.0   # seconds between event-loop lag probes
+LOOP_LAG_PROBE = 0.1      # the probe's timer, in seconds
+LOOP_STALL_WARNING = 0.25  # seconds; loop lag above this gets logged
+
+class Histogram:
+    """
+    Counts of observations per HISTOGRAM_BUCKETS bucket, plus count, sum and max.
+    """
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)  # the last bucket is everything above 30s
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Upper bound (seconds) of the bucket holding the q-th quantile, capped at the largest observation.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {"count": 0}
+        buckets = {f"le_{bound * 1000:g}ms": count for bound, count in zip(HISTOGRAM_BUCKETS, self.counts) if count}
+        if self.counts[-1]:
+            buckets[f"gt_{HISTOGRAM_BUCKETS[-1] * 1000:g}ms"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 2),
+            "p50_ms": round(self.quantile(0.5) * 1000, 2),
+            "p90_ms": round(self.quantile(0.9) * 1000, 2),
+            "p99_ms": round(self.quantile(0.99) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+            "buckets": buckets
+        }
+
+class Metrics:
+    """
+    Named histograms, created on first use. Only touched from the event loop thread.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.started_at = time.time()
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    async def timed(self, name, awaitable):
+        """
+        Awaits awaitable and records how long it took under name, whether it succeeded or not.
+        """
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def report(self):
+        return {name: self.histograms[name].snapshot() for name in sorted(self.histograms)}
+
+metrics = Metrics()
 
-@app.route("/callback")
-def callback():
-    code = request.args.get("code")
-    state = request.args.get("state")
-    error = request.args.get("error")
+class LoopProfiler:
+    """
+    cProfile of the event loop thread, started and stopped at runtime.
+    """
+    def __init__(self):
+        self._profile = None
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self):
+        if self._profile is not None:
+            return False
+        import cProfile
+
+        self._profile = cProfile.Profile()
+        self.started_at = time.time()
+        self._profile.enable()
+        return True
+
+    def stop(self, limit=40):
+        """
+        Stops profiling and returns the top `limit` functions by cumulative time as text.
+        """
+        if self._profile is None:
+            return None
+        import pstats
+
+        self._profile.disable()
+        out = io.StringIO()
+        out.write(f"Profiled {time.time() - self.started_at:.1f}s\n")
+        pstats.Stats(self._profile, stream=out).sort_stats("cumulative").print_stats(limit)
+        self._profile = None
+        return out.getvalue()
+
+loop_profiler = LoopProfiler()
+
+def metrics_report():
+    """
+    Everything /metrics serves: process info, game gauges, scheduler counters and histograms.
+    """
+    active_games = [game_state for game_state in game_registry.games.values() if game_state.status]
+    return {
+        "process": {
+            "shard_ids": SHARD_IDS,
+            "shard_count": SHARD_COUNT,
+            "uptime": round(time.time() - metrics.started_at, 1),
+            "profiling": loop_profiler.running
+        },
+        "gauges": {
+            "active_games": len(active_games),
+            "rounds_in_progress": sum(1 for game_state in active_games if game_state.round_in_progress),
+            "players": sum(len(game_state.players) for game_state in active_games),
+            "guilds": len(bot.guilds) if bot.is_ready() else None,
+            "outboxes": len(outboxes),
+            "cached_libraries": len(library_cache),
+            "spotify_clients": len(spotify_clients)
+        },
+        "spotify_scheduler": spotify_scheduler.report(),
+        "round_scheduler": round_scheduler.report(),
+        "histograms": metrics.report()
+    }
+
+@tasks.loop(seconds=LOOP_LAG_INTERVAL)
+async def monitor_loop_lag():
+    """
+    Measures how late a short timer fires; anything blocking the loop shows up as lag.
+    """
+    loop = asyncio.get_running_loop()
+    expected = loop.time() + LOOP_LAG_PROBE
+    await asyncio.sleep(LOOP_LAG_PROBE)
+    lag = max(0.0, loop.time() - expected)
+    metrics.observe("loop.lag", lag)
+    if lag > LOOP_STALL_WARNING:
+        print(f"DEBUG: Event loop stalled for {lag:.3f}s")
+
+# ----- WEB SERVER FOR SPOTIFY OAUTH -----
+# Served by aiohttp on the bot's own event loop, so the callback works with bot
+# state directly instead of hopping threads.
+routes = web.RouteTableDef()
+
+@routes.get("/")
+async def index(request):
+    """
+    Health check. Answers as soon as the web server is up: 503 with the startup state
+    until the bot is ready to serve, then 200.
+    """
+    state = readiness()
+    return web.json_response(state, status=200 if state["ready"] else 503)
+
+def metrics_authorized(request, required):
+    if not METRICS_TOKEN:
+        return not required
+    return request.query.get("token") == METRICS_TOKEN
+
+@routes.get("/metrics")
+async def metrics_endpoint(request):
+    if not metrics_authorized(request, required=False):
+        return web.Response(text="Forbidden", status=403)
+    return web.json_response(metrics_report())
+
+@routes.get("/debug/profile")
+async def profile_endpoint(request):
+    """
+    ?action=start begins profiling the event loop; ?action=stop ends it and returns the stats.
+    """
+    if not metrics_authorized(request, required=True):
+        return web.Response(text="Forbidden", status=403)
+    action = request.query.get("action")
+    if action == "start":
+        started = loop_profiler.start()
+        return web.Response(text="Profiling started." if started else "Already profiling.")
+    if action == "stop":
+        stats = loop_profiler.stop()
+        return web.Response(text=stats if stats is not None else "Not profiling.")
+    return web.Response(text="Use ?action=start or ?action=stop.", status=400)
+
+@routes.get("/callback")
+async def callback(request):
+    code = request.query.get("code")
+    state = request.query.get("state")
+    error = request.query.get("error")
 
     if error:
-        return f"There was an error during Spotify authorization: {error}", 400
+        return web.Response(text=f"There was an error during Spotify authorization: {error}", status=400)
 
     if code:
+        discord_user_id = str(state)
         try:
-            sp_oauth = create_spotify_oauth(state=state)
-            token_info = sp_oauth.get_access_token(code, check_cache=False)
+            token_info = await metrics.timed("spotify.get_access_token", run_spotify(exchange_auth_code, discord_user_id, code))
         except Exception as e:
-            return f"Error obtaining access token: {e}", 400
+            return web.Response(text=f"Error obtaining access token: {e}", status=400)
 
         if token_info:
-            discord_user_id = str(state)
-            print(f"DEBUG: Received token_info for Discord user {discord_user_id}: {token_info}")
-            user_spotify_data[discord_user_id] = token_info
-            print(f"DEBUG: user_spotify_data keys are now: {list(user_spotify_data.keys())}")
-
-            def confirm_authorization():
-                async def confirm_authorization_async():
-                    print(f"DEBUG: confirm_authorization triggered for user {discord_user_id}")
-                    guild_channel = join_channels.get(discord_user_id)
-                    if not guild_channel:
-                        print(f"DEBUG: No stored guild/channel for user {discord_user_id}")
-                        return
-
-                    guild_id, channel_id = guild_channel
-                    print(f"DEBUG: For user {discord_user_id}, got guild_id={guild_id}, channel_id={channel_id}")
-
-                    channel = bot.get_channel(channel_id)
-                    print(f"DEBUG: get_channel({channel_id}) returned: {channel}")
-                    if channel is None:
-                        print("DEBUG: Could not find channel object (check permissions).")
-                        return
-
-                    try:
-                        user_obj = await bot.fetch_user(int(discord_user_id))
-                        print(f"DEBUG: fetch_user({discord_user_id}) returned: {user_obj}")
-                    except Exception as ex:
-                        print(f"DEBUG: Exception fetching user {discord_user_id}: {ex}")
-                        return
-
-                    if user_obj is not None:
-                        msg = f"{user_obj.mention} is now ready to play!"
-                        await channel.send(msg)
-                    else:
-                        print(f"DEBUG: Could not fetch user object for {discord_user_id} to mention.")
-
-                asyncio.run_coroutine_threadsafe(confirm_authorization_async(), bot.loop)
-
-            bot.loop.call_soon_threadsafe(confirm_authorization)
-            return "Authorization successful! You can close this tab and return to Discord."
+            print(f"DEBUG: Stored Spotify token for Discord user {discord_user_id}")
+            await route_authorization(discord_user_id)
+            return web.Response(text="Authorization successful! You can close this tab and return to Discord.")
         else:
-            return "Could not get token info from Spotify.", 400
+            return web.Response(text="Could not get token info from Spotify.", status=400)
     else:
-        return "No code returned from Spotify.", 400
+        return web.Response(text="No code returned from Spotify.", status=400)
+
+def exchange_auth_code(discord_user_id, code):
+    """
+    Trades an authorization code for tokens and stores them. Blocking; runs on the Spotify thread pool.
+    """
+    token_info = get_spotify_oauth().get_access_token(code, check_cache=False)
+    if token_info:
+        token_store.set(discord_user_id, token_info)
+    return token_info
+
+async def route_authorization(discord_user_id):
+    """
+    Hands a fresh authorization to every process owning a guild the user joined a game in;
+    each warms the user's library cache (it's per process) and announces them in their
+    sessions. Handled here when the user has no recent joins.
+    """
+    guild_ids = await asyncio.get_running_loop().run_in_executor(None, shared_state.join_guilds, discord_user_id)
+    shard_ids = {shard_of(guild_id) for guild_id in guild_ids}
+    if not shard_ids or shard_ids & set(SHARD_IDS):
+        bot.loop.create_task(warm_library(discord_user_id))
+        bot.loop.create_task(confirm_authorization(discord_user_id))
+
+    for shard_id in shard_ids.difference(SHARD_IDS):
+        print(f"DEBUG: Routing authorization of Discord user {discord_user_id} to shard {shard_id}")
+        await asyncio.get_running_loop().run_in_executor(
+            None, shared_state.post_event, shard_id, "authorized", {"user_id": discord_user_id}
+        )
+
+async def confirm_authorization(discord_user_id):
+    """
+    Tells each session the user has joined that they're ready to play.
+    """
+    channel_ids = game_registry.sessions_of(discord_user_id)
+    if not channel_ids:
+        print(f"DEBUG: No game sessions for user {discord_user_id}")
+        return
+
+    for channel_id in list(channel_ids):
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            print(f"DEBUG: Could not find channel {channel_id} (check permissions).")
+            continue
+        await send_message(channel, f"<@{discord_user_id}> is now ready to play!")
+
+def refresh_stored_token(discord_user_id):
+    """
+    Exchanges the stored refresh token for a new access token and saves it. Blocking.
+    """
+    token_info = token_store.get(discord_user_id)
+    token_info = get_spotify_oauth().refresh_access_token(token_info["refresh_token"])
+    token_store.set(discord_user_id, token_info)
+    return token_info
 
 def get_spotify_client(discord_user_id):
-    token_info = user_spotify_data.get(str(discord_user_id))
+    from spotipy.oauth2 import SpotifyOAuth
+
+    token_info = token_store.get(discord_user_id)
     if not token_info:
         return None
 
-    sp_oauth = create_spotify_oauth(state=str(discord_user_id))
-    if sp_oauth.is_token_expired(token_info):
+    # The refresh scheduler gets here first for recent players; everyone else is refreshed here
+    if SpotifyOAuth.is_token_expired(token_info):
         try:
-            token_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
-            user_spotify_data[str(discord_user_id)] = token_info
+            token_info = refresh_stored_token(discord_user_id)
         except Exception as e:
             print(f"DEBUG: Error refreshing token for Discord user {discord_user_id}: {e}")
             return None
 
-    return spotipy.Spotify(auth=token_info["access_token"])
+    return spotify_clients.get(discord_user_id, token_info["access_token"])
+
+# ----- TRACK POOL -----
+class Track:
+    """
+    One guessable track. owner_ids holds the Discord user IDs who have it in their library.
+    """
+    __slots__ = ("track_id", "name", "artist", "album_cover_url", "preview_url", "owner_ids")
+
+    def __init__(self, track_id, name, artist, album_cover_url, owner_ids=None, preview_url=None):
+        self.track_id = track_id
+        self.name = name
+        self.artist = artist
+        self.album_cover_url = album_cover_url
+        self.preview_url = preview_url  # 30-second MP3 clip; Spotify leaves it null for some tracks
+        self.owner_ids = owner_ids if owner_ids is not None else set()
+
+    @classmethod
+    def from_spotify(cls, track):
+        """
+        Builds a Track from a Spotify track object. Returns None for tracks without an ID (local files).
+        """
+        if not track.get("id"):
+            return None
+        images = track["album"]["images"]
+        return cls(
+            track["id"], track["name"], track["artists"][0]["name"], images[0]["url"] if images else None,
+            preview_url=track.get("preview_url")
+        )
+
+    def copy(self):
+        """
+        Returns the same track with no owners, so cached records are never shared between pools.
+        """
+        return Track(self.track_id, self.name, self.artist, self.album_cover_url, preview_url=self.preview_url)
+
+    def to_list(self):
+        return [self.track_id, self.name, self.artist, self.album_cover_url, sorted(self.owner_ids), self.preview_url]
+
+    @classmethod
+    def from_list(cls, data):
+        track_id, name, artist, album_cover_url, owner_ids, *rest = data  # checkpoints from before previews have 5 fields
+        return cls(track_id, name, artist, album_cover_url, set(owner_ids), preview_url=rest[0] if rest else None)
+
+class TrackPool:
+    """
+    The tracks for one game, keyed by track ID, plus an index of which tracks each player owns.
+    Iteration and indexing follow the play order, which plan_rounds() sets.
+    """
+    __slots__ = ("tracks", "order", "player_tracks")
+
+    def __init__(self):
+        self.tracks = {}          # { track_id: Track }
+        self.order = []           # [ track_id, ... ] in play order
+        self.player_tracks = {}   # { player_id: { track_id, ... } }
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return (self.tracks[track_id] for track_id in self.order)
+
+    def __getitem__(self, index):
+        return self.tracks[self.order[index]]
+
+    def __contains__(self, track_id):
+        return track_id in self.tracks
+
+    def add(self, track, player_id):
+        """
+        Adds player_id as an owner of track, inserting the track if it is new to the pool.
+        """
+        existing = self.tracks.get(track.track_id)
+        if existing is None:
+            existing = self.tracks[track.track_id] = track
+            self.order.append(track.track_id)
+        existing.owner_ids.add(player_id)
+        self.player_tracks.setdefault(player_id, set()).add(track.track_id)
+        return existing
+
+    def merge_player(self, player_id, tracks):
+        """
+        Adds a player's Track records to the pool. Each track costs one dict lookup.
+        """
+        owned = self.player_tracks.setdefault(player_id, set())
+        for track in tracks:
+            if track.track_id in owned:
+                continue
+            self.add(self.tracks.get(track.track_id) or track.copy(), player_id)
+
+    def to_dict(self):
+        return {"tracks": [self.tracks[track_id].to_list() for track_id in self.order]}
+
+    @classmethod
+    def from_dict(cls, data):
+        pool = cls()
+        for entry in data["tracks"]:
+            track = Track.from_list(entry)
+            pool.tracks[track.track_id] = track
+            pool.order.append(track.track_id)
+            for player_id in track.owner_ids:
+                pool.player_tracks.setdefault(player_id, set()).add(track.track_id)
+        return pool
+
+# ----- ROUND PLANNER -----
+# The whole game is planned at !play: which track each round plays, and the embed and
+# answer text it sends. The round loop then only sends ready-made payloads.
+SHARED_TRACK_WEIGHT = 0.5   # odds, relative to 1, of a shared track right after another shared track
+REPEAT_OWNER_WEIGHT = 0.25  # odds, relative to 1, of a track sharing an owner with the previous round's
+
+def plan_rounds(track_pool, rounds, rng=random):
+    """
+    Returns up to `rounds` track IDs from track_pool in play order. Each round goes to the player
+    who has owned the fewest rounds so far (ties broken at random), so a big library can't crowd
+    out a small one. The track is then sampled from that player's unplayed tracks, weighted away
+    from tracks that share owners with the previous round, which spreads shared tracks out.
+    """
+    unplayed = {player_id: set(track_ids) for player_id, track_ids in track_pool.player_tracks.items() if track_ids}
+    appearances = dict.fromkeys(unplayed, 0)
+    previous_owners = set()
+    plan = []
+    while len(plan) < rounds and unplayed:
+        fewest = min(appearances[player_id] for player_id in unplayed)
+        player_id = rng.choice([player_id for player_id in unplayed if appearances[player_id] == fewest])
+
+        candidates = sorted(unplayed[player_id])  # sorted so a seeded rng gives the same plan
+        weights = []
+        for track_id in candidates:
+            owner_ids = track_pool.tracks[track_id].owner_ids
+            weight = 1.0
+            if len(owner_ids) > 1 and len(previous_owners) > 1:
+                weight *= SHARED_TRACK_WEIGHT
+            if (owner_ids - {player_id}) & previous_owners:
+                weight *= REPEAT_OWNER_WEIGHT
+            weights.append(weight)
+        track_id = rng.choices(candidates, weights)[0]
+
+        plan.append(track_id)
+        previous_owners = track_pool.tracks[track_id].owner_ids
+        for owner_id in previous_owners:
+            appearances[owner_id] = appearances.get(owner_id, 0) + 1
+            owned = unplayed.get(owner_id)
+            if owned is not None:
+                owned.discard(track_id)
+                if not owned:
+                    del unplayed[owner_id]
+    return plan
+
+class PlannedRound:
+    """
+    One round's track with its embed and answer text already rendered.
+    """
+    __slots__ = ("track", "embed", "correct_text", "missed_text")
+
+    def __init__(self, track, embed, correct_text, missed_text):
+        self.track = track
+        self.embed = embed
+        self.correct_text = correct_text  # followed by the winners' mentions
+        self.missed_text = missed_text
+
+def render_round(number, track, round_length, how_to_guess):
+    spotify_track_url = f"https://open.spotify.com/track/{track.track_id}"
+
+    # Create embed with cover art, Spotify link, and attribution
+    embed = discord.Embed(
+        title=f"Guess Round {number}",
+        description=f"**Track:** [{track.name}]({spotify_track_url})\n**Artist:** {track.artist}\n\nYou have {round_length} seconds! {how_to_guess}",
+        color=0x1DB954  # Spotify's brand green color
+    )
+    if track.album_cover_url:
+        embed.set_thumbnail(url=track.album_cover_url)
+    embed.set_footer(text="Powered by Spotify", icon_url="https://storage.googleapis.com/pr-newsroom-wp/1/2018/11/Spotify_Logo_RGB_Green.png")
+
+    owner_mentions = ", ".join(f"<@{o}>" for o in track.owner_ids)
+    correct_text = f"Time's up! The correct owner(s) for '[{track.name}]({spotify_track_url})' was {owner_mentions}.\n"
+    missed_text = (
+        f"Time's up! No one guessed correctly.\n"
+        f"The track '[{track.name}]({spotify_track_url})' belongs to {owner_mentions}."
+    )
+    return PlannedRound(track, embed, correct_text, missed_text)
+
+def render_rounds(game_state):
+    """
+    Pre-renders a PlannedRound for every track in the game's play order.
+    """
+    if game_state.guess_options:
+        how_to_guess = "Pick the owner from the menu below, or type `!guess @username`."
+    else:
+        how_to_guess = "Type `!guess @username` to guess."
+    if game_state.voice is not None:
+        how_to_guess = f"Listen to the preview in {game_state.voice.channel.mention}. {how_to_guess}"
+    return [
+        render_round(number, track, game_state.round_length, how_to_guess)
+        for number, track in enumerate(game_state.track_pool, start=1)
+    ]
+
+# ----- USER LIBRARY CACHE -----
+# Players usually run game after game (often in several guilds), so each user's
+# recently played list and a snapshot of liked-song pages are kept in memory.
+LIBRARY_CACHE_TTL = int(os.getenv("LIBRARY_CACHE_TTL", 900))     # seconds before a library is re-synced
+LIBRARY_CACHE_SIZE = int(os.getenv("LIBRARY_CACHE_SIZE", 500))   # users kept in memory
+RECENT_TRACKS_CACHED = 50  # Spotify's largest page for recently played
+LIKED_PAGES_CACHED = 6
+
+class UserLibrary:
+    """
+    The cached part of one user's Spotify library, as Track records without owners.
+    """
+    __slots__ = ("recent", "recent_cursor", "recent_synced_at", "liked_total", "liked_pages", "liked_synced_at")
+
+    def __init__(self):
+        self.recent = []              # newest first
+        self.recent_cursor = None     # Spotify "after" cursor: timestamp (ms) of the newest play seen
+        self.recent_synced_at = 0.0
+        self.liked_total = None
+        self.liked_pages = {}         # { page_index: [Track or None, ...] }, the most recently fetched pages
+        self.liked_synced_at = 0.0
+
+class LibraryCache:
+    """
+    UserLibrary per Discord user ID. Entries go stale after ttl seconds and
+    at most max_users are kept, evicting the least recently used.
+    """
+    def __init__(self, max_users, ttl):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._libraries = OrderedDict()
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        library = self._libraries.get(user_id)
+        if library is None:
+            library = self._libraries[user_id] = UserLibrary()
+            while len(self._libraries) > self.max_users:
+                self._libraries.popitem(last=False)
+        self._libraries.move_to_end(user_id)
+        return library
+
+    def invalidate(self, user_id):
+        self._libraries.pop(str(user_id), None)
+
+    def __len__(self):
+        return len(self._libraries)
+
+    def is_fresh(self, synced_at):
+        return time.time() - synced_at < self.ttl
+
+library_cache = LibraryCache(LIBRARY_CACHE_SIZE, LIBRARY_CACHE_TTL)
+
+# ----- SPOTIFY REQUEST SCHEDULER -----
+# Every Web API call goes through one scheduler: a global token bucket keeps the
+# app under Spotify's app-wide rate limit, a 429 pauses everyone for Retry-After,
+# each user gets a few concurrent requests at most, and identical requests that
+# are already in flight (same user in two guilds) share one round-trip.
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", 20))  # requests per second, app-wide (split across shard processes)
+SPOTIFY_BURST = int(os.getenv("SPOTIFY_BURST", 40))
+SPOTIFY_USER_CONCURRENCY = 4
+SPOTIFY_MAX_RETRIES = 3
+SPOTIFY_MAX_RETRY_WAIT = 30  # seconds; a longer Retry-After fails the request instead of waiting
+
+spotify_executor = ThreadPoolExecutor(max_workers=SPOTIFY_MAX_WORKERS, thread_name_prefix="spotify")
+
+async def run_spotify(func, *args, **kwargs):
+    """
+    Runs a blocking spotipy call on the Spotify thread pool and awaits its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(spotify_executor, functools.partial(func, *args, **kwargs))
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second with bursts up to `capacity`, and can be paused outright.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class SpotifyScheduler:
+    """
+    Rate-limited, per-user-bounded, deduplicating front door for Spotify Web API calls.
+    """
+    def __init__(self, rate, burst, per_user, max_retries):
+        self.bucket = TokenBucket(rate, burst)
+        self.per_user = per_user
+        self.max_retries = max_retries
+        self._user_slots = {}   # { user_id: [Semaphore, users_of_it] }, only while the user has requests
+        self._in_flight = {}    # { (user_id, method, kwargs): Task }
+        self.requests = 0
+        self.coalesced = 0
+        self.throttled = 0
+
+    async def request(self, user_id, sp_client, method, **kwargs):
+        """
+        Calls sp_client.<method>(**kwargs) for user_id under the scheduler's limits.
+        If the same call for the same user is already in flight, waits for that one instead.
+        """
+        key = (str(user_id), method, tuple(sorted(kwargs.items())))
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.get_running_loop().create_task(self._call(key[0], sp_client, method, kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        # Shielded so a caller timing out doesn't cancel the request for the others sharing it
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved; callers that are still waiting get it re-raised
+
+    async def _call(self, user_id, sp_client, method, kwargs):
+        from spotipy.exceptions import SpotifyException
+
+        slot = self._user_slots.get(user_id)
+        if slot is None:
+            slot = self._user_slots[user_id] = [asyncio.Semaphore(self.per_user), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                for attempt in range(self.max_retries + 1):
+                    await self.bucket.acquire()
+                    self.requests += 1
+                    try:
+                        return await metrics.timed(f"spotify.{method}", run_spotify(getattr(sp_client, method), **kwargs))
+                    except SpotifyException as e:
+                        if e.http_status != 429:
+                            raise
+                        retry_after = float((e.headers or {}).get("Retry-After", 1))
+                        self.throttled += 1
+                        self.bucket.pause(retry_after)
+                        print(f"DEBUG: Spotify rate limited {method} for user {user_id}; pausing {retry_after}s")
+                        if attempt == self.max_retries or retry_after > SPOTIFY_MAX_RETRY_WAIT:
+                            raise
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self._user_slots[user_id]
+
+    def report(self):
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "throttled": self.throttled,
+            "in_flight": len(self._in_flight),
+            "paused_for": max(0.0, self.bucket.paused_until - time.monotonic())
+        }
+
+spotify_scheduler = SpotifyScheduler(SPOTIFY_RATE_LIMIT, SPOTIFY_BURST, SPOTIFY_USER_CONCURRENCY, SPOTIFY_MAX_RETRIES)
+
+# ----- SPOTIFY TRACK GATHERING -----
+# Spotipy is blocking, so every call runs on a bounded thread pool and all
+# players are fetched at the same time. Building a pool takes as long as the
+# slowest player, and the bot keeps serving other guilds meanwhile.
+PLAYER_FETCH_TIMEOUT = float(os.getenv("PLAYER_FETCH_TIMEOUT", 15))
+TRACKS_PER_PLAYER = 20
+LIKED_PAGE_SIZE = 50  # Spotify's largest page for saved tracks
+
+def parse_tracks(items):
+    """
+    Turns a page of Spotify items ({"track": {...}, ...}) into Track records, skipping local files.
+    """
+    tracks = (Track.from_spotify(item["track"]) for item in items if item.get("track"))
+    return [track for track in tracks if track is not None]
+
+def parse_liked_page(items):
+    """
+    Like parse_tracks, but keeps each item's position: a local file or missing track becomes None.
+    """
+    return [Track.from_spotify(item["track"]) if item.get("track") else None for item in items]
+
+async def sync_recent_tracks(player_id, sp_client):
+    """
+    Returns the player's cached recently played tracks, newest first. Once stale, only
+    plays newer than the last sync are fetched, using Spotify's "after" cursor.
+    """
+    library = library_cache.get(player_id)
+    if library_cache.is_fresh(library.recent_synced_at):
+        return library.recent
+
+    results = await spotify_scheduler.request(
+        player_id, sp_client, "current_user_recently_played", limit=RECENT_TRACKS_CACHED, after=library.recent_cursor
+    )
+    cursor = (results.get("cursors") or {}).get("after")
+    if cursor:
+        library.recent_cursor = cursor
+
+    merged = []
+    seen = set()
+    for track in parse_tracks(results["items"]) + library.recent:
+        if track.track_id not in seen:
+            seen.add(track.track_id)
+            merged.append(track)
+    library.recent = merged[:RECENT_TRACKS_CACHED]
+    library.recent_synced_at = time.time()
+    return library.recent
+
+async def sync_liked_total(player_id, sp_client):
+    """
+    Returns how many liked songs the player has. Once stale, page 0 is fetched as a probe
+    for the library size and the cached pages are dropped, since likes and unlikes shift
+    songs between pages even when the total stays the same.
+    """
+    library = library_cache.get(player_id)
+    if not library_cache.is_fresh(library.liked_synced_at):
+        first_page = await spotify_scheduler.request(player_id, sp_client, "current_user_saved_tracks", limit=LIKED_PAGE_SIZE)
+        library.liked_total = first_page["total"]
+        library.liked_pages = {0: parse_liked_page(first_page["items"])}
+        library.liked_synced_at = time.time()
+    return library.liked_total
+
+async def sync_liked_pages(player_id, sp_client, pages):
+    """
+    Returns { page_index: [Track or None, ...] } for the given 50-track pages of the player's
+    liked songs. Pages fetched recently come from memory; the rest are fetched concurrently.
+    Call sync_liked_total first, so a stale snapshot has been dropped.
+    """
+    library = library_cache.get(player_id)
+
+    async def fetch_page(page):
+        if page in library.liked_pages:
+            return library.liked_pages[page]
+        try:
+            result = await spotify_scheduler.request(
+                player_id, sp_client, "current_user_saved_tracks", limit=LIKED_PAGE_SIZE, offset=page * LIKED_PAGE_SIZE
+            )
+        except Exception as e:
+            print(f"Error fetching liked tracks page at offset {page * LIKED_PAGE_SIZE} for user {player_id}: {e}")
+            return []
+        tracks = parse_liked_page(result["items"])
+        if len(library.liked_pages) >= LIKED_PAGES_CACHED:
+            # Dicts keep insertion order, so this drops the page fetched longest ago
+            del library.liked_pages[next(iter(library.liked_pages))]
+        library.liked_pages[page] = tracks
+        return tracks
+
+    pages = list(pages)
+    return dict(zip(pages, await asyncio.gather(*(fetch_page(page) for page in pages))))
+
+async def fetch_recent_tracks(player_id, sp_client):
+    tracks = await sync_recent_tracks(player_id, sp_client)
+    return tracks[:TRACKS_PER_PLAYER]
+
+async def fetch_liked_tracks(player_id, sp_client):
+    """
+    Samples up to TRACKS_PER_PLAYER liked songs: distinct offsets are drawn uniformly from the
+    whole library and only the 50-track pages they fall in are fetched, so the draw is the same
+    as fetching each offset on its own. The number of requests grows with the library: a large
+    one costs close to one page per song.
+    """
+    total = await sync_liked_total(player_id, sp_client)
+    if not total:
+        print(f"User {player_id} has no liked songs")
+        return []
+
+    offsets = random.sample(range(total), min(TRACKS_PER_PLAYER, total))
+    pages = await sync_liked_pages(player_id, sp_client, {offset // LIKED_PAGE_SIZE for offset in offsets})
+    tracks = []
+    for offset in offsets:
+        page = pages[offset // LIKED_PAGE_SIZE]
+        index = offset % LIKED_PAGE_SIZE
+        # Skips local files, and offsets past the end if songs were unliked since the total was read
+        if index < len(page) and page[index] is not None:
+            tracks.append(page[index])
+    return tracks
+
+async def warm_library(discord_user_id):
+    """
+    Prefetches a newly authorized user's recently played list and liked-songs count, so their
+    first !play builds from memory and their first !playlikes only fetches the pages it draws.
+    """
+    library_cache.invalidate(discord_user_id)  # they may have authorized a different Spotify account
+    try:
+        sp_client = await run_spotify(get_spotify_client, discord_user_id)
+        if sp_client is None:
+            return
+        # Each game draws its own liked pages, so warming more than the total rarely pays off
+        await asyncio.gather(
+            sync_recent_tracks(discord_user_id, sp_client),
+            sync_liked_total(discord_user_id, sp_client)
+        )
+    except Exception as e:
+        print(f"DEBUG: Error warming library cache for Discord user {discord_user_id}: {e}")
+
+async def fetch_player_tracks(player_id, fetch_tracks):
+    """
+    Builds the player's client (refreshing the token if needed) and runs fetch_tracks with it.
+    Returns a list of Track records.
+    """
+    refresh = token_refreshes.get(str(player_id))
+    if refresh is not None:
+        # Started at !join; waiting for it beats refreshing a second time inline
+        await asyncio.shield(refresh)
+    sp_client = await run_spotify(get_spotify_client, player_id)
+    if sp_client is None:
+        print(f"DEBUG: No Spotify client for user {player_id} (not authorized). Skipping tracks.")
+        return []
+    return await fetch_tracks(player_id, sp_client)
+
+async def build_track_pool(player_ids, fetch_tracks):
+    """
+    Fetches every player's tracks concurrently, each bounded by PLAYER_FETCH_TIMEOUT.
+    Returns a TrackPool of everyone's tracks.
+    """
+    async def fetch_one(player_id):
+        try:
+            return await asyncio.wait_for(fetch_player_tracks(player_id, fetch_tracks), PLAYER_FETCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"DEBUG: Timed out fetching tracks for user {player_id} after {PLAYER_FETCH_TIMEOUT}s. Skipping tracks.")
+        except Exception as e:
+            print(f"Error fetching tracks for user {player_id}: {e}")
+        return []
+
+    player_ids = list(player_ids)
+    results = await metrics.timed("game.pool_build", asyncio.gather(*(fetch_one(player_id) for player_id in player_ids)))
+
+    track_pool = TrackPool()
+    for player_id, tracks in zip(player_ids, results):
+        track_pool.merge_player(player_id, tracks)
+
+    return track_pool
+
+token_refresh_slots = asyncio.Semaphore(TOKEN_REFRESH_CONCURRENCY)
+token_refreshes = {}  # { user_id: Task } for refreshes in flight
+
+async def refresh_token(user_id):
+    """
+    Refreshes one stored token through the Spotify rate limiter, TOKEN_REFRESH_CONCURRENCY at a
+    time across the process. A revoked refresh token is deleted.
+    """
+    from spotipy.oauth2 import SpotifyOauthError
+
+    try:
+        async with token_refresh_slots:
+            await spotify_scheduler.bucket.acquire()
+            await metrics.timed("spotify.refresh_access_token", run_spotify(refresh_stored_token, user_id))
+    except SpotifyOauthError as e:
+        if e.error != "invalid_grant":
+            print(f"DEBUG: Error refreshing token for Discord user {user_id}: {e}")
+            return
+        # The user revoked access; they'll need to authorize again
+        print(f"DEBUG: Refresh token for Discord user {user_id} was revoked. Removing it.")
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, token_store.delete, user_id)
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error removing the token of Discord user {user_id}: {e}")
+            return
+        spotify_clients.invalidate(user_id)
+    except Exception as e:
+        print(f"DEBUG: Error refreshing token for Discord user {user_id}: {e}")
+
+def start_token_refresh(user_id):
+    """
+    Starts refreshing the user's token unless a refresh is already in flight. Returns its task.
+    """
+    user_id = str(user_id)
+    task = token_refreshes.get(user_id)
+    if task is None:
+        task = token_refreshes[user_id] = asyncio.get_running_loop().create_task(refresh_token(user_id))
+        task.add_done_callback(lambda _done: token_refreshes.pop(user_id, None))
+    return task
+
+def token_expires_soon(token_info):
+    return token_info.get("expires_at", 0) < time.time() + TOKEN_REFRESH_MARGIN
+
+@tasks.loop(seconds=TOKEN_REFRESH_INTERVAL)
+async def refresh_expiring_tokens():
+    """
+    Refreshes the tokens of players who recently joined a game shortly before they expire, so
+    starting a game never waits on a refresh; !join covers a returning player's first game.
+    Everyone else is refreshed on demand by get_spotify_client. Refreshes go a few at a time,
+    soonest expiry first, so the backlog after a long downtime doesn't go out in one burst.
+    """
+    try:
+        active = set(await asyncio.get_running_loop().run_in_executor(None, shared_state.recent_joiners))
+    except sqlite3.Error as e:
+        print(f"DEBUG: Error reading recent joins, skipping this token refresh pass: {e}")
+        return
+    due = [user_id for user_id in token_store.expiring_before(time.time() + TOKEN_REFRESH_MARGIN) if user_id in active]
+    await asyncio.gather(*(start_token_refresh(user_id) for user_id in due[:TOKEN_REFRESH_BATCH]))
+
+@tasks.loop(seconds=STATE_SWEEP_INTERVAL)
+async def sweep_idle_state():
+    """
+    Drops idle sessions and stale join entries so memory stays flat on long-running processes.
+    """
+    sessions_evicted = game_registry.sweep()
+    try:
+        joins_evicted = await asyncio.get_running_loop().run_in_executor(
+            None, shared_state.forget_joins_before, time.time() - STATE_IDLE_TTL
+        )
+    except sqlite3.Error as e:
+        print(f"DEBUG: Error dropping stale join entries, retrying on the next sweep: {e}")
+        joins_evicted = 0
+    if sessions_evicted or joins_evicted:
+        print(f"DEBUG: Evicted {sessions_evicted} idle sessions and {joins_evicted} stale join entries")
+
+@tasks.loop(seconds=SHARD_EVENT_POLL_INTERVAL)
+async def deliver_shard_events():
+    """
+    Handles events another process routed to this process's shards. The router posts one event
+    per shard, so a user whose guilds sit on several of ours is only handled once.
+    """
+    try:
+        events = await asyncio.get_running_loop().run_in_executor(None, shared_state.take_events, SHARD_IDS)
+    except sqlite3.Error as e:
+        print(f"DEBUG: Error taking shard events: {e}")
+        return
+    authorized = set()
+    for kind, payload in events:
+        if kind == "authorized":
+            authorized.add(payload["user_id"])
+        else:
+            print(f"DEBUG: Ignoring unknown shard event {kind}")
+    for user_id in authorized:
+        bot.loop.create_task(warm_library(user_id))
+        bot.loop.create_task(confirm_authorization(user_id))
+
+async def flush_checkpoints():
+    """
+    Saves every game that changed since the last pass and deletes checkpoints of games that ended.
+    Only the serialization runs on the loop; the database write runs in a worker thread.
+    """
+    writes = []
+    written = []
+    for channel_id, game_state in game_registry.games.items():
+        if game_state.status and game_state.dirty:
+            writes.append((channel_id, game_state.guild_id, json.dumps(game_state.to_dict(), separators=(",", ":"))))
+            written.append(game_state)
+            game_state.dirty = False
+    deletes = [
+        channel_id for channel_id in checkpointed_sessions
+        if channel_id not in game_registry.games or not game_registry.games[channel_id].status
+    ]
+    if not writes and not deletes:
+        return
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, checkpoint_store.save, writes, deletes)
+    except sqlite3.Error as e:
+        print(f"DEBUG: Error saving {len(writes)} checkpoints, retrying on the next pass: {e}")
+        for game_state in written:
+            game_state.dirty = True
+        return
+    checkpointed_sessions.difference_update(deletes)
+    checkpointed_sessions.update(channel_id for channel_id, _guild_id, _state in writes)
+
+@tasks.loop(seconds=CHECKPOINT_INTERVAL)
+async def checkpoint_games():
+    await flush_checkpoints()
+
+async def restore_games():
+    """
+    Reloads checkpointed games after a restart and resumes any that were mid-game at the saved round.
+    Only this process's shards are restored; the other shard processes pick up their own guilds.
+    """
+    try:
+        checkpoints = await asyncio.get_running_loop().run_in_executor(None, checkpoint_store.load_all, owns_guild)
+    except sqlite3.Error as e:
+        print(f"DEBUG: Error loading checkpoints, starting without them: {e}")
+        return
+    for channel_id, (guild_id, state) in checkpoints.items():
+        # Any checkpoint that isn't restored gets deleted on the next flush
+        checkpointed_sessions.add(channel_id)
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            print(f"DEBUG: Dropping checkpoint for guild {guild_id}: channel {channel_id} not found")
+            continue
+
+        try:
+            game_state = GameState.from_dict(json.loads(state))
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            print(f"DEBUG: Dropping unreadable checkpoint for channel {channel_id}: {e!r}")
+            continue
+        game_state.guild_id = guild_id
+        game_registry.add(channel_id, game_state)
+        if len(game_state.track_pool):
+            # One task per game, so no game waits on the others' announcements
+            bot.loop.create_task(resume_game(channel, game_state))
+    if checkpoints:
+        print(f"DEBUG: Restored {len(game_registry.games)} of {len(checkpoints)} checkpointed games")
+
+async def resume_game(channel, game_state):
+    """
+    Announces a restored game and plays on from its saved round.
+    """
+    await send_message(channel, f"I restarted! Picking the game back up at round {game_state.current_round + 1}.")
+    await start_round(channel, game_state, game_state.generation)
+
+def memory_report():
+    """
+    Sizes of the bot's long-lived in-memory structures.
+    """
+    report = game_registry.memory_report()
+    report.update({
+        "guild_settings": len(guild_settings),
+        "outboxes": len(outboxes),
+        "pending_rounds": round_scheduler.report()["pending"],
+        "cached_libraries": len(library_cache),
+        "spotify_clients": len(spotify_clients),
+        "stored_tokens": len(token_store),
+        "spotify_in_flight": spotify_scheduler.report()["in_flight"],
+        "clips_in_memory": len(clip_cache),
+        "clip_memory_bytes": clip_cache.memory_used
+    })
+    return report
+
+# ----- OUTBOUND MESSAGES -----
+# Game chatter goes through a per-channel outbox that stays inside Discord's
+# per-channel rate limit. Round announcements jump the queue, and guess
+# acknowledgements that pile up are merged into a single message.
+CHANNEL_SEND_RATE = 5        # messages allowed per channel...
+CHANNEL_SEND_PERIOD = 5.0    # ...in this many seconds
+PRIORITY_ROUND = 0           # round embeds, results and scoreboards
+PRIORITY_NORMAL = 1
+PRIORITY_ACK = 2             # replies to guesses
+
+class ChannelOutbox:
+    """
+    Pending messages for one channel, sent in priority order (FIFO within a priority)
+    without going over CHANNEL_SEND_RATE messages per CHANNEL_SEND_PERIOD.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self._queue = []       # heap of (priority, seq, send_kwargs, future)
+        self._acks = []        # mentions waiting for a merged "guess recorded" message
+        self._sent_at = deque()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def put(self, priority, **send_kwargs):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), send_kwargs, future))
+        self._ensure_draining()
+        return future
+
+    def ack(self, mention):
+        self._acks.append(mention)
+        self._ensure_draining()
+
+    def _ensure_draining(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._drain())
+        self._wakeup.set()
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._queue:
+                _priority, _seq, send_kwargs, future = heapq.heappop(self._queue)
+            elif self._acks:
+                mentions, self._acks = ", ".join(self._acks), []
+                if "," in mentions:
+                    send_kwargs, future = {"content": f"{mentions} your guesses have been recorded!"}, None
+                else:
+                    send_kwargs, future = {"content": f"{mentions} your guess has been recorded!"}, None
+            else:
+                # Idle: linger until the rate window clears, so a quick follow-up still sees the budget
+                idle_for = CHANNEL_SEND_PERIOD - (loop.time() - self._sent_at[-1]) if self._sent_at else 0
+                if idle_for <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), idle_for)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._wait_for_budget()
+            try:
+                message = await metrics.timed("discord.send", self.channel.send(**send_kwargs))
+            except Exception as e:
+                if future is None:
+                    print(f"DEBUG: Error sending guess acknowledgement to channel {self.channel.id}: {e}")
+                elif not future.done():
+                    future.set_exception(e)
+            else:
+                if future is not None and not future.done():
+                    future.set_result(message)
+
+        if outboxes.get(self.channel.id) is self:
+            del outboxes[self.channel.id]
+
+    async def _wait_for_budget(self):
+        loop = asyncio.get_running_loop()
+        while len(self._sent_at) >= CHANNEL_SEND_RATE:
+            wait = self._sent_at[0] + CHANNEL_SEND_PERIOD - loop.time()
+            if wait <= 0:
+                self._sent_at.popleft()
+            else:
+                await asyncio.sleep(wait)
+        self._sent_at.append(loop.time())
+
+outboxes = {}  # { channel_id: ChannelOutbox }, only while a channel has recent traffic
+
+def get_outbox(channel):
+    outbox = outboxes.get(channel.id)
+    if outbox is None:
+        outbox = outboxes[channel.id] = ChannelOutbox(channel)
+    return outbox
+
+async def send_message(channel, content=None, *, embed=None, view=None, priority=PRIORITY_NORMAL):
+    """
+    Queues a message on the channel's outbox and waits until it has been sent.
+    """
+    return await get_outbox(channel).put(priority, content=content, embed=embed, view=view)
+
+def ack_guess(channel, mention):
+    """
+    Queues a "guess recorded" reply. Replies waiting together are sent as one message.
+    """
+    get_outbox(channel).ack(mention)
+
+# ----- ROUND SCHEDULER -----
+ROUND_LATE_WARNING = 0.5  # seconds; deadlines firing later than this get logged
+
+class RoundScheduler:
+    """
+    Holds every guild's round deadline in one heap, served by a single task.
+    Deadlines that come due together are fired as one batch. Each key has at most
+    one pending deadline; rescheduling or cancelling leaves the old heap entry
+    behind, and it is skipped when popped.
+    """
+    def __init__(self):
+        self._heap = []       # [ (deadline, seq, key) ]
+        self._entries = {}    # { key: (deadline, seq, callback, args) }, the live deadline per key
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._batches = set()
+        self.fired = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.last_lateness = 0.0
+
+    def schedule(self, key, delay, callback, *args):
+        """
+        Calls `await callback(*args)` in delay seconds, replacing any deadline already pending for key.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        seq = next(self._seq)
+        self._entries[key] = (deadline, seq, callback, args)
+        heapq.heappush(self._heap, (deadline, seq, key))
+
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        elif self._heap[0][1] == seq:
+            # New earliest deadline; wake the runner so it doesn't oversleep
+            self._wakeup.set()
+
+    def cancel(self, key):
+        self._entries.pop(key, None)
+
+    def reschedule(self, key, delay):
+        """
+        Brings key's pending deadline forward to delay seconds from now, keeping its callback.
+        Never pushes a deadline later. Returns True if the deadline moved.
+        """
+        entry = self._entries.get(key)
+        if entry is None or asyncio.get_running_loop().time() + delay >= entry[0]:
+            return False
+        self.schedule(key, delay, entry[2], *entry[3])
+        return True
+
+    def remaining(self, key):
+        """
+        Seconds until key's pending deadline, or None if nothing is pending.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return max(0.0, entry[0] - asyncio.get_running_loop().time())
+
+    def report(self):
+        return {
+            "pending": len(self._entries),
+            "fired": self.fired,
+            "mean_lateness": self.total_lateness / self.fired if self.fired else 0.0,
+            "max_lateness": self.max_lateness,
+            "last_lateness": self.last_lateness
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._entries:
+            now = loop.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, seq, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry is None or entry[1] != seq:
+                    continue  # cancelled or rescheduled
+                del self._entries[key]
+                due.append((key, entry))
+
+            if due:
+                for key, (deadline, _seq, _callback, _args) in due:
+                    self._record_lateness(key, now - deadline)
+                batch = loop.create_task(self._fire(due))
+                self._batches.add(batch)
+                batch.add_done_callback(self._batches.discard)
+                continue
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        # Whatever is left in the heap was cancelled or rescheduled
+        self._heap.clear()
+
+    async def _fire(self, due):
+        results = await asyncio.gather(*(callback(*args) for _key, (_deadline, _seq, callback, args) in due), return_exceptions=True)
+        for (key, _entry), result in zip(due, results):
+            if isinstance(result, Exception):
+                print(f"DEBUG: Round callback for {key} raised: {result!r}")
+
+    def _record_lateness(self, key, lateness):
+        self.fired += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.last_lateness = lateness
+        metrics.observe("round.drift", lateness)
+        if lateness > ROUND_LATE_WARNING:
+            print(f"DEBUG: Round deadline for {key} fired {lateness:.3f}s late")
+
+round_scheduler = RoundScheduler()
+
+# ----- GUESS MENU -----
+def record_guess(game_state, guesser_id, guessed_user_id):
+    """
+    Records a guess for the running round and, in fast mode, closes the round early when due.
+    Returns a message explaining why the guess was refused, or None if it was recorded.
+    """
+    if not game_state.status:
+        return "No active game in this channel right now."
+    if not game_state.round_in_progress:
+        return "No guessing period is active right now or time is up!"
+    if guesser_id in game_state.round_guesses:
+        return "You have already guessed this round!"
+
+    game_state.round_guesses[guesser_id] = guessed_user_id
+    game_state.dirty = True
+    game_state.touch()
+
+    # In fast mode, close the round early
+    if game_state.fast_mode:
+        if game_state.players <= game_state.round_guesses.keys():
+            round_scheduler.reschedule(game_state.channel_id, 0)
+        elif game_state.grace and len(game_state.round_guesses) == 1:
+            round_scheduler.reschedule(game_state.channel_id, game_state.grace)
+    return None
+
+class GuessSelect(discord.ui.Select):
+    """
+    Menu of the joined players. Picks are answered ephemerally, so guessing adds no channel messages.
+    """
+    def __init__(self, game_state, round_number, options):
+        super().__init__(placeholder="Whose track is this?", options=options)
+        self.game_state = game_state
+        self.round_number = round_number
+
+    async def callback(self, interaction):
+        if self.game_state.current_round != self.round_number:
+            error = "That round is over!"
+        else:
+            error = record_guess(self.game_state, str(interaction.user.id), self.values[0])
+        await interaction.response.send_message(error or f"Your guess (<@{self.values[0]}>) has been recorded!", ephemeral=True)
+
+class GuessView(discord.ui.View):
+    def __init__(self, game_state, round_number, options):
+        super().__init__(timeout=game_state.round_length + 5)
+        self.add_item(GuessSelect(game_state, round_number, options))
+
+def build_guess_options(game_state):
+    """
+    Select options for the joined players, built once per game. Discord allows 25 at most;
+    anyone past that can still be guessed with !guess.
+    """
+    names = game_state.player_names
+    return [
+        discord.SelectOption(label=names.get(player_id, player_id)[:100], value=player_id)
+        for player_id in sorted(game_state.players, key=lambda p: names.get(p, p).lower())[:25]
+    ]
+
+# ----- VOICE PREVIEWS -----
+# In voice preview mode each round also plays the track's 30-second preview in voice chat.
+# Clips are decoded to raw PCM ahead of time (the next round's while the current one plays),
+# so starting a clip is just handing bytes to discord.PCMAudio.
+VOICE_CLIP_SECONDS = 30
+CLIP_FETCH_TIMEOUT = 15  # seconds to download and decode one clip
+CLIP_CACHE_DIR = os.getenv("CLIP_CACHE_DIR", "clip_cache")
+CLIP_DISK_BYTES = int(os.getenv("CLIP_DISK_BYTES", 512 * 2**20))
+CLIP_MEMORY_BYTES = int(os.getenv("CLIP_MEMORY_BYTES", 48 * 2**20))  # ~8 decoded clips
+# A directory of local audio files to play instead of Spotify's preview URLs (offline testing).
+# <track_id>.<ext> is used when present; otherwise every track maps to one of the files.
+PREVIEW_DIR = os.getenv("PREVIEW_DIR")
+FFMPEG = os.getenv("FFMPEG", "ffmpeg")
+
+def voice_supported():
+    """
+    Voice needs PyNaCl (discord.py[voice]) and an ffmpeg binary to decode previews.
+    """
+    return discord.voice_client.has_nacl and shutil.which(FFMPEG) is not None
+
+@functools.lru_cache(maxsize=1)
+def local_preview_files():
+    return sorted(
+        os.path.join(PREVIEW_DIR, name) for name in os.listdir(PREVIEW_DIR)
+        if os.path.isfile(os.path.join(PREVIEW_DIR, name))
+    )
+
+def preview_source(track):
+    """
+    Where to read the track's clip from: a local file under PREVIEW_DIR, else its preview URL (or None).
+    """
+    if PREVIEW_DIR:
+        files = local_preview_files()
+        if not files:
+            return None
+        for path in files:
+            if os.path.splitext(os.path.basename(path))[0] == track.track_id:
+                return path
+        return files[zlib.crc32(track.track_id.encode()) % len(files)]
+    return track.preview_url
+
+def download_preview(url):
+    """
+    Fetches a preview MP3 over the pooled Spotify session. Blocking.
+    """
+    response = get_spotify_session().get(url, timeout=CLIP_FETCH_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+async def decode_clip(source):
+    """
+    Decodes up to VOICE_CLIP_SECONDS of source (a URL or a local file) to 48 kHz stereo
+    16-bit PCM, the format discord.PCMAudio plays.
+    """
+    data = None
+    if source.startswith(("http://", "https://")):
+        data = await asyncio.get_running_loop().run_in_executor(None, download_preview, source)
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, "-loglevel", "error", "-i", "pipe:0" if data is not None else source,
+        "-t", str(VOICE_CLIP_SECONDS), "-f", "s16le", "-ar", "48000", "-ac", "2", "pipe:1",
+        stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        pcm, stderr = await process.communicate(data)
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+    return pcm
+
+class ClipCache:
+    """
+    Decoded preview clips keyed by track ID. The most recently used stay in memory up to
+    memory_bytes; every clip is also kept on disk up to disk_bytes, evicting the least recently
+    used, so a repeated track is never downloaded twice. A clip being fetched is shared by
+    everyone who asks for it.
+    """
+    def __init__(self, directory, memory_bytes, disk_bytes):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory_used = 0
+        self._memory = OrderedDict()  # { track_id: pcm }
+        self._disk = None             # { track_id: size }, least recently used first; loaded on first use
+        self._disk_used = 0
+        self._in_flight = {}          # { track_id: Task }
+        self._prefetches = set()
+        self.fetched = 0
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _path(self, track_id):
+        return os.path.join(self.directory, f"{track_id}.pcm")
+
+    async def get(self, track):
+        """
+        Returns the track's decoded clip, or None if it has no preview or it couldn't be fetched.
+        """
+        pcm = self._memory.get(track.track_id)
+        if pcm is not None:
+            self._memory.move_to_end(track.track_id)
+            return pcm
+
+        task = self._in_flight.get(track.track_id)
+        if task is None:
+            task = self._in_flight[track.track_id] = asyncio.get_running_loop().create_task(self._load(track))
+            task.add_done_callback(lambda _done: self._in_flight.pop(track.track_id, None))
+        return await asyncio.shield(task)
+
+    def prefetch(self, track):
+        """
+        Starts loading the track's clip in the background if it isn't in memory or on its way.
+        """
+        if track.track_id in self._memory or track.track_id in self._in_flight:
+            return
+        task = asyncio.get_running_loop().create_task(self.get(track))
+        self._prefetches.add(task)
+        task.add_done_callback(self._prefetches.discard)
+
+    async def _load(self, track):
+        import requests
+
+        loop = asyncio.get_running_loop()
+        if self._disk is None:
+            self._disk = await loop.run_in_executor(None, self._scan_disk)
+            self._disk_used = sum(self._disk.values())
+
+        if track.track_id in self._disk:
+            self._disk.move_to_end(track.track_id)
+            try:
+                pcm = await loop.run_in_executor(None, self._read, track.track_id)
+            except OSError as e:
+                print(f"DEBUG: Error reading cached clip for track {track.track_id}: {e}")
+                self._disk_used -= self._disk.pop(track.track_id)
+                return None
+        else:
+            source = preview_source(track)
+            if source is None:
+                return None
+            try:
+                pcm = await asyncio.wait_for(decode_clip(source), CLIP_FETCH_TIMEOUT)
+            except (asyncio.TimeoutError, OSError, RuntimeError, requests.RequestException) as e:
+                print(f"DEBUG: Error fetching preview for track {track.track_id}: {e!r}")
+                return None
+            self.fetched += 1
+            self._disk[track.track_id] = len(pcm)
+            self._disk_used += len(pcm)
+            evicted = []
+            while self._disk_used > self.disk_bytes and len(self._disk) > 1:
+                track_id, size = self._disk.popitem(last=False)
+                self._disk_used -= size
+                evicted.append(track_id)
+            loop.run_in_executor(None, self._write, track.track_id, pcm, evicted)
+
+        self._memory[track.track_id] = pcm
+        self.memory_used += len(pcm)
+        while self.memory_used > self.memory_bytes and len(self._memory) > 1:
+            _track_id, evicted_pcm = self._memory.popitem(last=False)
+            self.memory_used -= len(evicted_pcm)
+        return pcm
+
+    def _scan_disk(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pcm"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(".pcm")], stat.st_size))
+        return OrderedDict((track_id, size) for _mtime, track_id, size in sorted(entries))
+
+    def _read(self, track_id):
+        path = self._path(track_id)
+        os.utime(path)  # keeps the on-disk LRU order across restarts
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _write(self, track_id, pcm, evicted):
+        try:
+            with open(self._path(track_id), "wb") as f:
+                f.write(pcm)
+            for evicted_id in evicted:
+                os.remove(self._path(evicted_id))
+        except OSError as e:
+            print(f"DEBUG: Error updating clip cache on disk: {e}")
+
+clip_cache = ClipCache(CLIP_CACHE_DIR, CLIP_MEMORY_BYTES, CLIP_DISK_BYTES)
+
+async def connect_voice(ctx, game_state):
+    """
+    Joins the invoker's voice channel for preview mode, reusing the game's own connection when
+    it's replayed. Returns the VoiceClient, or None (after telling the channel why) if the game
+    has to go ahead without audio. Discord allows one voice connection per guild, so only one
+    session at a time gets previews.
+    """
+    if not voice_supported():
+        await ctx.send("Voice previews aren't available on this host (needs PyNaCl and ffmpeg). Playing without audio.")
+        return None
+    voice_state = getattr(ctx.author, "voice", None)
+    if voice_state is None or voice_state.channel is None:
+        await ctx.send("Join a voice channel before `!play` to hear previews. Playing without audio this time.")
+        return None
+
+    voice = game_state.voice
+    if voice is not None and voice.is_connected():
+        try:
+            if voice.channel != voice_state.channel:
+                await voice.move_to(voice_state.channel)
+            return voice
+        except (discord.DiscordException, asyncio.TimeoutError) as e:
+            print(f"DEBUG: Error moving voice in guild {ctx.guild.id}: {e!r}")
+            await ctx.send("Couldn't join your voice channel. Playing without audio.")
+            return None
+
+    voice = ctx.guild.voice_client
+    if voice is not None and voice.is_connected():
+        await ctx.send("Another game in this server is already playing previews. Playing without audio.")
+        return None
+    try:
+        if voice is not None:
+            # Left over from a connection that dropped; start clean
+            await voice.disconnect(force=True)
+        return await voice_state.channel.connect()
+    except (discord.DiscordException, asyncio.TimeoutError) as e:
+        print(f"DEBUG: Error connecting to voice in guild {ctx.guild.id}: {e!r}")
+        await ctx.send("Couldn't join your voice channel. Playing without audio.")
+        return None
+
+async def play_round_clip(game_state, round_index, generation):
+    """
+    Plays the round's clip once it's ready (normally it was prefetched during the previous round)
+    and starts fetching the next round's.
+    """
+    if round_index + 1 < len(game_state.round_plan):
+        clip_cache.prefetch(game_state.round_plan[round_index + 1].track)
+    pcm = await clip_cache.get(game_state.round_plan[round_index].track)
+
+    voice = game_state.voice
+    if pcm is None or voice is None or not voice.is_connected():
+        return
+    # The round may have ended, or the game been replanned, while the clip was loading
+    if (not game_state.round_in_progress or game_state.current_round != round_index
+            or game_state.generation != generation):
+        return
+    try:
+        if voice.is_playing():
+            voice.stop()
+        voice.play(discord.PCMAudio(io.BytesIO(pcm)))
+    except discord.DiscordException as e:
+        print(f"DEBUG: Error playing preview: {e!r}")
+
+def stop_clip(game_state):
+    if game_state.voice is not None and game_state.voice.is_playing():
+        game_state.voice.stop()
+
+async def leave_voice(game_state):
+    voice, game_state.voice = game_state.voice, None
+    if voice is not None and voice.is_connected():
+        try:
+            await voice.disconnect()
+        except discord.DiscordException as e:
+            print(f"DEBUG: Error leaving voice: {e!r}")
 
 # ----- DISCORD BOT SETUP -----
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents)
+if SHARD_COUNT > 1:
+    bot = commands.AutoShardedBot(command_prefix=BOT_PREFIX, intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents)
+
+slash_commands_synced = False
 
 @bot.event
 async def on_ready():
-    print(f"Bot logged in as {bot.user}")
+    global slash_commands_synced
+    print(f"Bot logged in as {bot.user} (shards {SHARD_IDS} of {SHARD_COUNT})")
+    mark_startup_phase("gateway_ready")
+    # Commands are global and tokens shared, so only the primary process syncs and refreshes them
+    if PRIMARY_PROCESS and not slash_commands_synced:
+        try:
+            synced = await bot.tree.sync()
+            print(f"DEBUG: Synced {len(synced)} slash commands")
+        except discord.HTTPException as e:
+            print(f"DEBUG: Error syncing slash commands: {e}")
+        slash_commands_synced = True
+    if not sweep_idle_state.is_running():
+        sweep_idle_state.start()
+    if not monitor_loop_lag.is_running():
+        monitor_loop_lag.start()
+    if not flush_leaderboard_results.is_running():
+        flush_leaderboard_results.start()
+    if SHARD_COUNT > 1 and not deliver_shard_events.is_running():
+        deliver_shard_events.start()
+    if not checkpoint_games.is_running():
+        await restore_games()
+        checkpoint_games.start()
+        mark_startup_phase("games_restored")
 
 # ----- DISCORD COMMANDS -----
-@bot.command()
+@bot.hybrid_command()
+@commands.guild_only()
 async def start(ctx):
+    """
+    Starts a new game in this channel. Other channels and threads can run their own at the same time.
+    """
     game_state = get_game_state(ctx)
-    if game_state["status"]:
-        await ctx.send("A game is already in progress in this server.")
+    if game_state.status:
+        await ctx.send("A game is already in progress in this channel. Start another one in a different channel or thread!")
         return
 
-    game_state["status"] = True
-    game_state["players"] = set()
-    game_state["track_pool"] = []
-    game_state["current_round"] = 0
-    game_state["round_in_progress"] = False
-    game_state["round_guesses"] = {}
-    game_state["points"] = {}
+    # A fresh object rather than a reset one, so a tally or scoreboard still running for the
+    # previous game sees that game is no longer live
+    game_registry.discard(ctx.channel.id)
+    game_state = get_game_state(ctx)
+    game_state.status = True
+    game_state.channel_id = ctx.channel.id
+    game_state.guild_id = ctx.guild.id
+    game_state.dirty = True
 
-    # If a leftover round task was still stored, cancel it to be safe
-    if game_state.get("round_task"):
-        game_state["round_task"].cancel()
-        game_state["round_task"] = None
+    # If a leftover round deadline was still pending, cancel it to be safe
+    round_scheduler.cancel(ctx.channel.id)
 
     await ctx.send("A new game has started! Type `!join` to participate.")
 
 @bot.command()
+@commands.guild_only()
+async def settings(ctx, rounds: int = None, round_length: int = None):
+    """
+    Shows or changes this server's number of rounds and seconds per round, e.g. `!settings 10 15`.
+    New values apply from the next !play.
+    """
+    guild_config = get_guild_settings(ctx.guild.id)
+    if rounds is not None:
+        if not 1 <= rounds <= MAX_ROUNDS:
+            await ctx.send(f"Rounds must be between 1 and {MAX_ROUNDS}.")
+            return
+        guild_config = update_guild_settings(ctx.guild.id, rounds=rounds)
+    if round_length is not None:
+        low, high = ROUND_LENGTH_RANGE
+        if not low <= round_length <= high:
+            await ctx.send(f"Round length must be between {low} and {high} seconds.")
+            return
+        guild_config = update_guild_settings(ctx.guild.id, round_length=round_length)
+
+    await ctx.send(f"Games here last up to {guild_config['rounds']} rounds of {guild_config['round_length']} seconds.")
+
+@bot.command()
+@commands.guild_only()
+async def fastmode(ctx, mode: str = None, grace: int = None):
+    """
+    `!fastmode on [grace_seconds]` ends each round as soon as every player has guessed,
+    and optionally cuts the round to grace_seconds once the first guess is in.
+    `!fastmode off` goes back to full-length rounds. Applies from the next !play.
+    """
+    guild_config = get_guild_settings(ctx.guild.id)
+    if mode is not None:
+        if mode.lower() not in ("on", "off"):
+            await ctx.send("Usage: `!fastmode on [grace_seconds]` or `!fastmode off`")
+            return
+        if grace is not None and not 1 <= grace <= ROUND_LENGTH_RANGE[1]:
+            await ctx.send(f"Grace window must be between 1 and {ROUND_LENGTH_RANGE[1]} seconds.")
+            return
+        fast_mode = mode.lower() == "on"
+        guild_config = update_guild_settings(ctx.guild.id, fast_mode=fast_mode, grace=grace if fast_mode else None)
+
+    if not guild_config["fast_mode"]:
+        await ctx.send("Fast mode is off: every round runs its full length.")
+    elif guild_config["grace"]:
+        await ctx.send(
+            f"Fast mode is on: rounds end once everyone has guessed, "
+            f"or {guild_config['grace']} seconds after the first guess."
+        )
+    else:
+        await ctx.send("Fast mode is on: rounds end as soon as everyone has guessed.")
+
+@bot.command()
+@commands.guild_only()
+async def voicemode(ctx, mode: str = None):
+    """
+    `!voicemode on` plays each track's 30-second preview in the voice channel of whoever runs
+    `!play`; `!voicemode off` goes back to text only. Applies from the next !play.
+    """
+    guild_config = get_guild_settings(ctx.guild.id)
+    if mode is not None:
+        if mode.lower() not in ("on", "off"):
+            await ctx.send("Usage: `!voicemode on` or `!voicemode off`")
+            return
+        guild_config = update_guild_settings(ctx.guild.id, voice_preview=mode.lower() == "on")
+    if guild_config["voice_preview"]:
+        await ctx.send("Voice previews are on: join a voice channel before `!play` to hear each track.")
+    else:
+        await ctx.send("Voice previews are off: rounds are text only.")
+
+@bot.command()
+@commands.guild_only()
+async def guessmode(ctx, mode: str = None):
+    """
+    `!guessmode menu` adds a player menu to each round embed; `!guessmode text` uses `!guess @user` only.
+    Applies from the next !play.
+    """
+    guild_config = get_guild_settings(ctx.guild.id)
+    if mode is not None:
+        if mode.lower() not in ("menu", "text"):
+            await ctx.send("Usage: `!guessmode menu` or `!guessmode text`")
+            return
+        guild_config = update_guild_settings(ctx.guild.id, guess_menu=mode.lower() == "menu")
+
+    if guild_config["guess_menu"]:
+        await ctx.send("Guess mode: pick the owner from the menu on each round (`!guess @user` still works).")
+    else:
+        await ctx.send("Guess mode: type `!guess @user`.")
+
+@bot.hybrid_command()
+@commands.guild_only()
 async def join(ctx):
+    """
+    Joins this channel's game and sends you a Spotify authorization link.
+    """
     game_state = get_game_state(ctx)
-    if not game_state["status"]:
+    if not game_state.status:
         await ctx.send("No game is currently running. Use `!start` to create a new game.")
         return
 
     user_id = str(ctx.author.id)
-    if user_id in game_state["players"]:
+    if user_id in game_state.players:
         await ctx.send("You have already joined the game.")
         return
 
-    join_channels[user_id] = (ctx.guild.id, ctx.channel.id)
-    game_state["players"].add(user_id)
+    game_state.players.add(user_id)
+    game_state.player_names[user_id] = ctx.author.display_name
+    game_state.dirty = True
+    game_registry.index_player(user_id, ctx.channel.id)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, shared_state.record_join, user_id, ctx.guild.id, ctx.channel.id)
+    # A returning player's token has often expired; refresh it now so !play doesn't wait on it
+    token_info = await loop.run_in_executor(None, token_store.get, user_id)
+    if token_info is not None and token_expires_soon(token_info):
+        start_token_refresh(user_id)
 
     await ctx.send(f"{ctx.author.mention}, check your DMs to optionally authorize Spotify.")
 
-    sp_oauth = create_spotify_oauth(state=user_id)
-    auth_url = sp_oauth.get_authorize_url()
+    auth_url = get_spotify_oauth().get_authorize_url(state=user_id)
 
     try:
         await ctx.author.send(
@@ -203,308 +2534,261 @@ async def join(ctx):
     except discord.Forbidden:
         await ctx.send("I couldn't DM you. Please enable your DMs or add me as a friend.")
 
-@bot.command()
+@bot.hybrid_command()
+@commands.guild_only()
 async def play(ctx):
     """
-    Gathers tracks and starts the first round by scheduling do_guess_round in a Task.
+    Gathers tracks and starts the first round.
     """
-    game_state = get_game_state(ctx)
-    if not game_state["status"]:
-        await ctx.send("No game is active. Use `!start` to begin.")
-        return
-    if len(game_state["players"]) < 2:
-        await ctx.send("Need at least 2 players to play!")
-        return
-
-    track_pool = []
-    user_track_ids = {}
-
-    for player_id in game_state["players"]:
-        sp_client = get_spotify_client(player_id)
-        if sp_client is None:
-            print(f"DEBUG: No Spotify client for user {player_id} (not authorized). Skipping tracks.")
-            continue
-
-        try:
-            user_info = sp_client.me()
-            _spotify_user_id = user_info.get("id", "unknown_id")
-            _spotify_display_name = user_info.get("display_name", "Unknown Display Name")
-        except Exception as e:
-            print(f"DEBUG: Error calling sp_client.me() for {player_id}: {e}")
-            continue
-
-        user_track_ids[player_id] = set()
-        try:
-            results = sp_client.current_user_recently_played(limit=20)
-            for item in results["items"]:
-                track = item["track"]
-                track_id = track["id"]
-                if not track_id:
-                    continue
-                if track_id in user_track_ids[player_id]:
-                    continue
-
-                user_track_ids[player_id].add(track_id)
-                track_name = track["name"]
-                artist_name = track["artists"][0]["name"]
-                # Get album cover URL
-                album_cover_url = track["album"]["images"][0]["url"] if track["album"]["images"] else None
-
-                existing_track = next((t for t in track_pool if t[0] == track_id), None)
-                if existing_track:
-                    existing_track[4].add(player_id)
-                else:
-                    track_pool.append((track_id, track_name, artist_name, album_cover_url, {player_id}))
-        except Exception as e:
-            print(f"Error fetching recent tracks for user {player_id}: {e}")
-
-    if not track_pool:
-        await ctx.send("No tracks found or nobody authorized. We'll proceed, but there's nothing to guess!")
-
-    random.shuffle(track_pool)
-    game_state["track_pool"] = track_pool
-    game_state["current_round"] = 0
-
-    # If a leftover round task existed, cancel it
-    if game_state.get("round_task"):
-        game_state["round_task"].cancel()
+    await gather_and_start(ctx, fetch_recent_tracks, "Track pool compiled! Starting the game...")
 
-    # Create a new task that runs do_guess_round
-    task = bot.loop.create_task(do_guess_round(ctx))
-    game_state["round_task"] = task
-
-    await ctx.send("Track pool compiled! Starting the game...")
-
-@bot.command()
+@bot.hybrid_command()
+@commands.guild_only()
 async def playlikes(ctx):
     """
     Similar to !play but uses random liked songs instead of recently played tracks.
     """
+    await gather_and_start(ctx, fetch_liked_tracks, "Track pool compiled from random liked songs! Starting the game...")
+
+async def gather_and_start(ctx, fetch_tracks, announcement):
+    """
+    Builds the track pool with fetch_tracks and starts the rounds. Other commands keep running
+    while the pool builds, so the game is re-checked afterwards in case it was ended or restarted.
+    """
+    await ctx.defer()  # gathering can outlast a slash command's 3-second reply window
     game_state = get_game_state(ctx)
-    if not game_state["status"]:
+    if not game_state.status:
         await ctx.send("No game is active. Use `!start` to begin.")
         return
-    if len(game_state["players"]) < 2:
+    if len(game_state.players) < 2:
         await ctx.send("Need at least 2 players to play!")
         return
+    if game_state.building:
+        await ctx.send("Still gathering tracks for this game, hang on!")
+        return
 
-    track_pool = []
-    user_track_ids = {}
-
-    for player_id in game_state["players"]:
-        sp_client = get_spotify_client(player_id)
-        if sp_client is None:
-            print(f"DEBUG: No Spotify client for user {player_id} (not authorized). Skipping tracks.")
-            continue
-
-        try:
-            user_info = sp_client.me()
-            _spotify_user_id = user_info.get("id", "unknown_id")
-            _spotify_display_name = user_info.get("display_name", "Unknown Display Name")
-        except Exception as e:
-            print(f"DEBUG: Error calling sp_client.me() for {player_id}: {e}")
-            continue
-
-        user_track_ids[player_id] = set()
-        try:
-            # First, get total number of liked songs
-            initial_results = sp_client.current_user_saved_tracks(limit=1)
-            total_tracks = initial_results["total"]
-            
-            if total_tracks == 0:
-                print(f"User {player_id} has no liked songs")
-                continue
+    game_state.building = True
+    try:
+        track_pool = await build_track_pool(game_state.players, fetch_tracks)
+    finally:
+        game_state.building = False
+    # ctx.defer() has run, so every path has to answer or a slash command hangs on "thinking..."
+    if not game_registry.is_live(game_state):
+        print(f"DEBUG: Game in channel {ctx.channel.id} ended while its track pool was building; dropping the pool")
+        await ctx.send("That game was ended before it could start.")
+        return
 
-            # Generate 20 random unique offsets within the user's library size
-            max_offset = max(0, total_tracks - 1)  # -1 because offset is 0-based
-            random_offsets = set()
-            while len(random_offsets) < min(20, total_tracks):
-                random_offsets.add(random.randint(0, max_offset))
-            
-            # Fetch each randomly selected track
-            for offset in random_offsets:
-                try:
-                    result = sp_client.current_user_saved_tracks(limit=1, offset=offset)
-                    if not result["items"]:
-                        continue
-                        
-                    item = result["items"][0]
-                    track = item["track"]
-                    track_id = track["id"]
-                    
-                    if not track_id or track_id in user_track_ids[player_id]:
-                        continue
-
-                    user_track_ids[player_id].add(track_id)
-                    track_name = track["name"]
-                    artist_name = track["artists"][0]["name"]
-                    album_cover_url = track["album"]["images"][0]["url"] if track["album"]["images"] else None
-
-                    existing_track = next((t for t in track_pool if t[0] == track_id), None)
-                    if existing_track:
-                        existing_track[4].add(player_id)
-                    else:
-                        track_pool.append((track_id, track_name, artist_name, album_cover_url, {player_id}))
-                except Exception as e:
-                    print(f"Error fetching individual track at offset {offset} for user {player_id}: {e}")
-                    continue
-                    
-        except Exception as e:
-            print(f"Error fetching liked tracks for user {player_id}: {e}")
+    if await start_guess_rounds(ctx, game_state, track_pool):
+        await ctx.send(announcement)
+    else:
+        await ctx.send("That game was ended before it could start.")
 
+async def start_guess_rounds(ctx, game_state, track_pool):
+    """
+    Plans the game's rounds from the pool, pre-renders them and starts the first round.
+    Returns False if the game ended while voice was being set up.
+    """
+    # Any round chain from an earlier !play stops at its next check
+    generation = game_state.generation = game_state.generation + 1
+    round_scheduler.cancel(ctx.channel.id)
+    game_state.round_in_progress = False
     if not track_pool:
         await ctx.send("No tracks found or nobody authorized. We'll proceed, but there's nothing to guess!")
 
-    random.shuffle(track_pool)
-    game_state["track_pool"] = track_pool
-    game_state["current_round"] = 0
-
-    # If a leftover round task existed, cancel it
-    if game_state.get("round_task"):
-        game_state["round_task"].cancel()
-
-    # Create a new task that runs do_guess_round
-    task = bot.loop.create_task(do_guess_round(ctx))
-    game_state["round_task"] = task
-
-    await ctx.send("Track pool compiled from random liked songs! Starting the game...")
-    
-async def do_guess_round(ctx):
+    guild_config = get_guild_settings(ctx.guild.id)
+    track_pool.order = plan_rounds(track_pool, guild_config["rounds"])
+    game_state.track_pool = track_pool
+    game_state.current_round = 0
+    game_state.rounds = guild_config["rounds"]
+    game_state.round_length = guild_config["round_length"]
+    game_state.fast_mode = guild_config["fast_mode"]
+    game_state.grace = guild_config["grace"]
+    game_state.guess_options = build_guess_options(game_state) if guild_config["guess_menu"] else None
+    voice = None
+    if guild_config["voice_preview"] and track_pool:
+        voice = await connect_voice(ctx, game_state)
+    if voice is not game_state.voice:
+        # A replayed game that's now without audio (or moved on to a new connection) lets go of the old one
+        await leave_voice(game_state)
+        game_state.voice = voice
+    if not game_registry.is_live(game_state, generation):
+        # Ended while we were connecting; if a later !play took over, the connection is its to keep
+        if game_state.generation == generation:
+            await leave_voice(game_state)
+        return False
+    game_state.round_plan = render_rounds(game_state)
+    game_state.channel_id = ctx.channel.id
+    game_state.dirty = True
+
+    if game_state.voice is not None:
+        # Have the first clip ready before round 1; play_round_clip keeps one round ahead from there
+        await clip_cache.get(game_state.round_plan[0].track)
+        if not game_registry.is_live(game_state, generation):
+            if game_state.generation == generation:
+                await leave_voice(game_state)
+            return False
+
+    bot.loop.create_task(start_round(ctx.channel, game_state, generation))
+    return True
+
+async def start_round(channel, game_state, generation):
     """
-    The main loop for each round.
-    We'll do the 10-second wait, awarding points, and move to next round
-    until we reach 20 or run out of tracks.
+    Posts the current round's pre-rendered embed and schedules its tally on the round scheduler.
+    Ends the game once we reach the round limit or run out of tracks.
+    generation is the !play this chain of rounds belongs to.
     """
-    try:
-        while True:
-            game_state = get_game_state(ctx)
-
-            # If the game is ended externally, bail out
-            if not game_state["status"]:
-                return
+    # If the game is ended or restarted externally, bail out
+    if not game_registry.is_live(game_state, generation):
+        return
 
-            # If we've used all tracks or hit 20 rounds, end game
-            if game_state["current_round"] >= len(game_state["track_pool"]) or game_state["current_round"] >= 20:
-                await announce_winner_and_reset(ctx, game_finished=True)
-                return
+    # If we've used all tracks or hit the round limit, end game
+    if game_state.current_round >= len(game_state.round_plan) or game_state.current_round >= game_state.rounds:
+        await announce_winner_and_reset(channel, game_state, game_finished=True)
+        return
 
-            track_id, track_name, artist_name, album_cover_url, owner_ids = game_state["track_pool"][game_state["current_round"]]
-            
-            # Create Spotify track URL
-            spotify_track_url = f"https://open.spotify.com/track/{track_id}"
-            
-            # Create embed with cover art, Spotify link, and attribution
-            embed = discord.Embed(
-                title=f"Guess Round {game_state['current_round']+1}",
-                description=f"**Track:** [{track_name}]({spotify_track_url})\n**Artist:** {artist_name}\n\nYou have 10 seconds! Type `!guess @username` to guess.",
-                color=0x1DB954  # Spotify's brand green color
-            )
-            if album_cover_url:
-                embed.set_thumbnail(url=album_cover_url)
-            
-            # Add Spotify attribution
-            embed.set_footer(text="Powered by Spotify", icon_url="https://storage.googleapis.com/pr-newsroom-wp/1/2018/11/Spotify_Logo_RGB_Green.png")
-            
-            await ctx.send(embed=embed)
-
-            game_state["round_in_progress"] = True
-            game_state["round_guesses"] = {}
-
-            # Sleep 10s
-            await asyncio.sleep(10)
-
-            # If the game is ended while we slept, bail out
-            if not game_state["status"]:
-                return
+    view = None
+    if game_state.guess_options:
+        view = GuessView(game_state, game_state.current_round, game_state.guess_options)
+    await send_message(channel, embed=game_state.round_plan[game_state.current_round].embed, view=view, priority=PRIORITY_ROUND)
 
-            game_state["round_in_progress"] = False
-
-            # Tally winners
-            winners = []
-            for guesser_id, guessed_user_id in game_state["round_guesses"].items():
-                if guessed_user_id in owner_ids:
-                    # skip awarding if guesser is the same user
-                    if guesser_id == guessed_user_id:
-                        continue
-                    winners.append(guesser_id)
-
-            # Award points
-            for w in winners:
-                if w not in game_state["points"]:
-                    game_state["points"][w] = 0
-                game_state["points"][w] += 1
-
-            if winners:
-                owner_mentions = ", ".join(f"<@{o}>" for o in owner_ids)
-                winner_mentions = ", ".join(f"<@{w}>" for w in winners)
-                await ctx.send(
-                    f"Time's up! The correct owner(s) for '[{track_name}]({spotify_track_url})' was {owner_mentions}.\n"
-                    f"Congrats to {winner_mentions} for guessing correctly!"
-                )
-            else:
-                owner_mentions = ", ".join(f"<@{o}>" for o in owner_ids)
-                await ctx.send(
-                    f"Time's up! No one guessed correctly.\n"
-                    f"The track '[{track_name}]({spotify_track_url})' belongs to {owner_mentions}."
-                )
+    # If the game is ended while we were sending, bail out
+    if not game_registry.is_live(game_state, generation):
+        return
 
-            # Move to the next round
-            game_state["current_round"] += 1
+    game_state.round_in_progress = True
+    game_state.round_guesses = {}
+    game_state.dirty = True
+    game_state.touch()
+    round_scheduler.schedule(channel.id, game_state.round_length, end_round, channel, game_state, generation)
+    if game_state.voice is not None:
+        bot.loop.create_task(play_round_clip(game_state, game_state.current_round, generation))
 
-    except asyncio.CancelledError:
-        # Round was cancelled (e.g., someone did !end or a new !play)
+async def end_round(channel, game_state, generation):
+    """
+    Fired by the round scheduler when a round's time is up: tallies guesses,
+    awards points, posts the answer and starts the next round.
+    """
+    # If the game is ended or restarted while the round ran, bail out
+    if not game_registry.is_live(game_state, generation):
         return
 
+    game_state.round_in_progress = False
+    stop_clip(game_state)
+    planned = game_state.round_plan[game_state.current_round]
+    track = planned.track
+
+    # Tally winners
+    winners = []
+    for guesser_id, guessed_user_id in game_state.round_guesses.items():
+        if guessed_user_id in track.owner_ids:
+            # skip awarding if guesser is the same user
+            if guesser_id == guessed_user_id:
+                continue
+            winners.append(guesser_id)
+
+    # Award points
+    for w in winners:
+        if w not in game_state.points:
+            game_state.points[w] = 0
+        game_state.points[w] += 1
+
+    # Move to the next round
+    game_state.current_round += 1
+    game_state.dirty = True
+    # Keeps the idle sweep off the session while the result and the next round are being sent
+    game_state.touch()
+
+    if winners:
+        winner_mentions = ", ".join(f"<@{w}>" for w in winners)
+        await send_message(
+            channel, planned.correct_text + f"Congrats to {winner_mentions} for guessing correctly!", priority=PRIORITY_ROUND
+        )
+    else:
+        await send_message(channel, planned.missed_text, priority=PRIORITY_ROUND)
+
+    await start_round(channel, game_state, generation)
+
+@bot.command()
+@commands.is_owner()
+async def memstats(ctx):
+    """
+    Shows the sizes of the bot's in-memory state. Bot owner only.
+    """
+    lines = [f"{key}: {value}" for key, value in memory_report().items()]
+    await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
 @bot.command()
+@commands.guild_only()
 async def guess(ctx, user_mention: discord.User = None):
-    game_state = get_game_state(ctx)
-    if not game_state["status"]:
-        await ctx.send("No active game in this server right now.")
-        return
-    if not game_state["round_in_progress"]:
-        await ctx.send("No guessing period is active right now or time is up!")
-        return
     if user_mention is None:
-        await ctx.send("Please mention a user to guess. Example: `!guess @SomeUser`")
+        await send_message(ctx.channel, "Please mention a user to guess. Example: `!guess @SomeUser`", priority=PRIORITY_ACK)
         return
 
-    guesser_id = str(ctx.author.id)
-    if guesser_id in game_state["round_guesses"]:
-        await ctx.send("You have already guessed this round!")
+    game_state = get_game_state(ctx)
+    error = record_guess(game_state, str(ctx.author.id), str(user_mention.id))
+    if error:
+        await send_message(ctx.channel, error, priority=PRIORITY_ACK)
         return
+    ack_guess(ctx.channel, ctx.author.mention)
 
-    guessed_user_id = str(user_mention.id)
-    game_state["round_guesses"][guesser_id] = guessed_user_id
-    await ctx.send(f"{ctx.author.mention} your guess has been recorded!")
-
-@bot.command()
+@bot.hybrid_command()
+@commands.guild_only()
 async def end(ctx):
     """
-    Ends the current game prematurely in this server. We still show the scoreboard.
-    Also cancel any ongoing round Task so it can't finish and cause a second scoreboard.
+    Ends this channel's game prematurely. We still show the scoreboard.
+    Also cancel any pending round deadline so it can't finish and cause a second scoreboard.
     """
     game_state = get_game_state(ctx)
-    if not game_state["status"]:
-        await ctx.send("No game is currently running in this server.")
+    if not game_state.status:
+        await ctx.send("No game is currently running in this channel.")
         return
 
-    # Cancel any ongoing round Task
-    if game_state.get("round_task"):
-        game_state["round_task"].cancel()
-        game_state["round_task"] = None
+    # Cancel any pending round deadline
+    round_scheduler.cancel(ctx.channel.id)
 
-    await announce_winner_and_reset(ctx, game_finished=False)
+    if ctx.interaction:
+        # The scoreboard goes to the channel; a slash command still needs its own reply
+        await ctx.send("Ending the game...", ephemeral=True)
+    await announce_winner_and_reset(ctx.channel, game_state, game_finished=False)
 
-async def announce_winner_and_reset(ctx, game_finished=True):
+@bot.hybrid_command()
+@commands.guild_only()
+async def leaderboard(ctx, scope: str = None):
     """
-    Announces the scoreboard for this server, then resets that server's game state.
+    Shows this server's all-time top players, or everyone's with `!leaderboard global`.
     """
-    game_state = get_game_state(ctx)
-    points_map = game_state["points"]
-    players = game_state["players"]
+    if scope is not None and scope.lower() != "global":
+        await ctx.send("Usage: `!leaderboard` or `!leaderboard global`")
+        return
+    board = GLOBAL_LEADERBOARD if scope else ctx.guild.id
+
+    # Write any buffered results first so games that just ended are counted
+    await flush_leaderboards()
+    rows = await asyncio.get_running_loop().run_in_executor(None, leaderboard_store.top, board, LEADERBOARD_SIZE)
+    if not rows:
+        await ctx.send("No finished games yet. Play one with `!start`!")
+        return
+
+    lines = [
+        f"**{rank}.** <@{user_id}>: {points} points, {wins} wins in {games} games ({wins / games:.0%})"
+        for rank, (user_id, points, games, wins) in enumerate(rows, start=1)
+    ]
+    embed = discord.Embed(
+        title="Global Leaderboard" if scope else "Leaderboard",
+        description="\n".join(lines),
+        color=0x1DB954
+    )
+    await ctx.send(embed=embed)
+
+async def announce_winner_and_reset(channel, game_state, game_finished=True):
+    """
+    Announces game_state's scoreboard, then drops the session from the channel.
+    """
+    points_map = game_state.points
+    players = game_state.players
 
     # Mark the status as False, so no new rounds continue
-    game_state["status"] = False
+    game_state.status = False
 
     for pid in players:
         points_map.setdefault(pid, 0)
@@ -515,47 +2799,186 @@ async def announce_winner_and_reset(ctx, game_finished=True):
     if scoreboard:
         top_score = scoreboard[0][1]
         winners = [uid for (uid, pts) in scoreboard if pts == top_score]
+        if game_state.current_round:
+            # Everyone tying on zero isn't a win
+            leaderboard_store.record_game(channel.guild.id, dict(scoreboard), winners if top_score else [])
 
         scoreboard_lines = [f"<@{uid}>: {pts} points" for (uid, pts) in scoreboard]
         scoreboard_str = "\n".join(scoreboard_lines)
 
+        headline = "Game over!" if game_finished else "Game ended prematurely!"
         if len(winners) == 1:
-            await ctx.send("Game over!" if game_finished else "Game ended prematurely!")
-            await ctx.send(
-                f"**Final Scores:**\n{scoreboard_str}\n\n"
-                f"**Winner:** <@{winners[0]}> with {top_score} points!"
+            await send_message(
+                channel,
+                f"{headline}\n**Final Scores:**\n{scoreboard_str}\n\n"
+                f"**Winner:** <@{winners[0]}> with {top_score} points!",
+                priority=PRIORITY_ROUND
             )
         else:
             tie_mentions = ", ".join(f"<@{w}>" for w in winners)
-            await ctx.send("Game over!" if game_finished else "Game ended prematurely!")
-            await ctx.send(
-                f"**Final Scores:**\n{scoreboard_str}\n\n"
-                f"**Winners (tie):** {tie_mentions} with {top_score} points each!"
+            await send_message(
+                channel,
+                f"{headline}\n**Final Scores:**\n{scoreboard_str}\n\n"
+                f"**Winners (tie):** {tie_mentions} with {top_score} points each!",
+                priority=PRIORITY_ROUND
             )
     else:
-        await ctx.send("No one scored any points, so no winner. Maybe no guesses?")
-
-    # Fully reset this server's state
-    guild_id = ctx.guild.id
-    active_games[guild_id] = {
-        "status": False,
-        "players": set(),
-        "track_pool": [],
-        "current_round": 0,
-        "round_in_progress": False,
-        "round_guesses": {},
-        "points": {},
-        "round_task": None
+        await send_message(channel, "No one scored any points, so no winner. Maybe no guesses?", priority=PRIORITY_ROUND)
+
+    await leave_voice(game_state)
+    # Fully reset this channel's state; a fresh one is created on the next command.
+    # A game started while the scoreboard went out already holds the channel, so leave that one be
+    if game_registry.games.get(channel.id) is game_state:
+        game_registry.discard(channel.id)
+
+# ----- RUN THE WEB SERVER AND THE BOT ON ONE EVENT LOOP -----
+# The web server comes up first so health checks get an answer right away; the token
+# store and spotipy load in worker threads while the bot connects to the gateway.
+startup_phases = {}  # { phase: seconds since the process started }
+startup_errors = {}  # { phase: error that phase ended with }
+TOKEN_STORE_LOAD_ATTEMPTS = 3
+TOKEN_STORE_LOAD_RETRY_DELAY = 5  # seconds
+
+def mark_startup_phase(name):
+    if name not in startup_phases:
+        startup_phases[name] = round(time.perf_counter() - PROCESS_STARTED, 3)
+        print(f"DEBUG: Startup phase {name} done at {startup_phases[name]}s")
+
+def readiness():
+    gateway_connected = bot.is_ready() and not bot.is_closed()
+    return {
+        "ready": gateway_connected and token_store.loaded,
+        "gateway_connected": gateway_connected,
+        "token_store_loaded": token_store.loaded,
+        "startup_phases": startup_phases,
+        "startup_errors": startup_errors
     }
 
-# ----- RUN FLASK (SPOTIFY OAUTH) IN A SEPARATE THREAD -----
-def run_flask():
-    port = int(os.getenv("PORT", 8080))
-    app.run(host='0.0.0.0', port=port)
+async def load_token_store():
+    """
+    Loads every stored token for the refresh scheduler, then starts it. Only the primary process
+    refreshes tokens, so the others skip the full read and report the store as loaded.
+    If every attempt fails, the store still counts as loaded so readiness can't get stuck:
+    get() reads missed tokens from the database, and the scheduler refreshes those it has seen.
+    """
+    if PRIMARY_PROCESS:
+        for attempt in range(1, TOKEN_STORE_LOAD_ATTEMPTS + 1):
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, token_store.load)
+                break
+            except sqlite3.Error as e:
+                print(f"DEBUG: Error loading the token store (attempt {attempt} of {TOKEN_STORE_LOAD_ATTEMPTS}): {e}")
+                if attempt == TOKEN_STORE_LOAD_ATTEMPTS:
+                    startup_errors["token_store"] = str(e)
+                    token_store.loaded = True
+                else:
+                    await asyncio.sleep(TOKEN_STORE_LOAD_RETRY_DELAY)
+        if not refresh_expiring_tokens.is_running():
+            refresh_expiring_tokens.start()
+    else:
+        token_store.loaded = True
+    mark_startup_phase("token_store")
 
-def keep_alive():
-    t = Thread(target=run_flask)
-    t.start()
+async def warm_spotify():
+    """
+    Warms spotipy ahead of the first game. On failure, the first Spotify call imports it instead.
+    """
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, warm_spotify_imports)
+    except Exception as e:
+        print(f"DEBUG: Error warming spotipy, leaving it to the first Spotify call: {e!r}")
+        startup_errors["spotify_imports"] = repr(e)
+        return
+    mark_startup_phase("spotify_imports")
+
+async def start_web_server():
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = int(os.getenv("PORT", 8080))
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    return runner
 
-keep_alive()
-bot.run(DISCORD_BOT_TOKEN)
\ No newline at end of file
+async def main():
+    mark_startup_phase("imports")
+    loop = asyncio.get_running_loop()
+    try:
+        # Railway stops the container with SIGTERM; close cleanly so the final checkpoint is written
+        loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(bot.close()))
+    except NotImplementedError:
+        pass
+
+    async with bot:
+        runner = None
+        if PRIMARY_PROCESS:
+            runner = await start_web_server()
+            mark_startup_phase("web_server")
+        startup_tasks = [loop.create_task(load_token_store()), loop.create_task(warm_spotify())]  # keep references
+        try:
+            await bot.start(DISCORD_BOT_TOKEN)
+        finally:
+            for task in startup_tasks:
+                task.cancel()
+            await flush_checkpoints()
+            await flush_leaderboards()
+            if runner is not None:
+                await runner.cleanup()
+
+def run_shard_processes():
+    """
+    Splits SHARD_COUNT shards across SHARD_PROCESSES child processes of this script and waits
+    for them. The first child is the primary. SIGTERM is passed on so each child checkpoints.
+    If a child exits on its own, the others are stopped and the supervisor exits non-zero.
+    The Spotify rate limit is app-wide, so each child gets an equal share of it.
+    """
+    process_count = min(SHARD_PROCESSES, SHARD_COUNT)
+    children = []
+    for index in range(process_count):
+        shard_ids = range(index, SHARD_COUNT, SHARD_PROCESSES)
+        env = dict(
+            os.environ,
+            SHARD_COUNT=str(SHARD_COUNT),
+            SHARD_IDS=",".join(map(str, shard_ids)),
+            SHARD_PROCESSES="1",
+            PRIMARY_PROCESS="1" if index == 0 else "0",
+            SPOTIFY_RATE_LIMIT=str(SPOTIFY_RATE_LIMIT / process_count),
+            SPOTIFY_BURST=str(max(1, SPOTIFY_BURST // process_count))
+        )
+        print(f"DEBUG: Starting shard process {index} with shards {list(shard_ids)}")
+        children.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+
+    stopping = False
+
+    def stop_children(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+
+    # A child that exits on its own leaves its shards offline, so take the rest down with it
+    # and exit non-zero for the platform to restart everything
+    while not any(child.poll() is not None for child in children):
+        time.sleep(SHARD_SUPERVISOR_POLL_INTERVAL)
+    crashed = not stopping
+    if crashed:
+        index, code = next((index, child.returncode) for index, child in enumerate(children) if child.returncode is not None)
+        print(f"DEBUG: Shard process {index} exited with code {code}; stopping the others")
+        stop_children(None, None)
+    codes = []
+    for child in children:
+        try:
+            codes.append(child.wait(timeout=SHARD_STOP_TIMEOUT))
+        except subprocess.TimeoutExpired:
+            child.kill()
+            codes.append(child.wait())
+    sys.exit(max(1, *codes) if crashed else max(codes))
+
+if __name__ == "__main__":
+    if SHARD_PROCESSES > 1:
+        run_shard_processes()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,15 @@
+"""
+main.py reads its configuration at import time, so the tests point it at throwaway paths
+before anything imports it.
+"""
+import os
+import sys
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix="squiddygame-tests-")
+os.environ["TOKEN_DB_PATH"] = os.path.join(TEST_DIR, "test.db")
+os.environ["CLIP_CACHE_DIR"] = os.path.join(TEST_DIR, "clip_cache")
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "test")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,90 @@
+import asyncio
+import random
+
+import pytest
+
+import main
+
+LIBRARY_SIZE = 2000  # 40 pages of liked songs
+
+
+class FakeScheduler:
+    """
+    Serves current_user_saved_tracks from a library of LIBRARY_SIZE songs and records the pages asked for.
+    """
+    def __init__(self, total=LIBRARY_SIZE):
+        self.total = total
+        self.pages = []
+
+    async def request(self, user_id, sp_client, method, limit, offset=0):
+        assert method == "current_user_saved_tracks"
+        self.pages.append(offset // limit)
+        items = [
+            {"track": {"id": f"t{i}", "name": f"Song {i}", "artists": [{"name": "Artist"}], "album": {"images": []}}}
+            for i in range(offset, min(offset + limit, self.total))
+        ]
+        return {"total": self.total, "items": items}
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = FakeScheduler()
+    monkeypatch.setattr(main, "spotify_scheduler", scheduler)
+    monkeypatch.setattr(main, "library_cache", main.LibraryCache(10, 900))
+    random.seed(6)
+    return scheduler
+
+
+def page_of(track):
+    return int(track.track_id[1:]) // main.LIKED_PAGE_SIZE
+
+
+@pytest.mark.parametrize("stale", [False, True])
+def test_each_game_samples_fresh_pages(scheduler, stale):
+    asyncio.run(main.sync_liked_pages("u1", None, range(main.LIKED_PAGES_CACHED)))
+
+    drawn = set()
+    for _ in range(30):
+        if stale:
+            main.library_cache.get("u1").liked_synced_at = 0.0
+        tracks = asyncio.run(main.fetch_liked_tracks("u1", None))
+        drawn.update(page_of(track) for track in tracks)
+
+    # Stuck on one snapshot, every game would draw from the same handful of pages
+    assert len(drawn) > 20
+
+
+def test_stale_snapshot_is_dropped_even_if_the_total_is_unchanged(scheduler):
+    asyncio.run(main.sync_liked_total("u1", None))
+    library = main.library_cache.get("u1")
+    library.liked_pages[39] = ["stale"]
+    library.liked_synced_at = 0.0
+
+    asyncio.run(main.sync_liked_total("u1", None))
+
+    assert library.liked_pages.get(39) != ["stale"]
+    assert len(library.liked_pages) <= main.LIKED_PAGES_CACHED
+
+
+def test_small_library_comes_from_memory(scheduler):
+    scheduler.total = 120  # 3 pages
+    asyncio.run(main.sync_liked_total("u1", None))
+    asyncio.run(main.sync_liked_pages("u1", None, range(3)))
+    requests = len(scheduler.pages)
+
+    for _ in range(10):
+        tracks = asyncio.run(main.fetch_liked_tracks("u1", None))
+        assert len(tracks) == main.TRACKS_PER_PLAYER
+
+    assert len(scheduler.pages) == requests
+
+
+def test_only_the_pages_of_the_drawn_songs_are_fetched(scheduler):
+    asyncio.run(main.sync_liked_total("u1", None))
+    main.library_cache.get("u1").liked_pages = {}
+    scheduler.pages = []
+
+    tracks = asyncio.run(main.fetch_liked_tracks("u1", None))
+
+    assert len({track.track_id for track in tracks}) == main.TRACKS_PER_PLAYER
+    assert sorted(scheduler.pages) == sorted({page_of(track) for track in tracks})
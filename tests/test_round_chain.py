@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def game(monkeypatch):
+    sent = []
+
+    async def fake_send(channel, content=None, **kwargs):
+        sent.append(content)
+
+    monkeypatch.setattr(main, "send_message", fake_send)
+    game_state = main.GameState()
+    game_state.status = True
+    game_state.channel_id = 1
+    track = main.Track("t1", "Song t1", "Artist", None)
+    game_state.round_plan = [main.PlannedRound(track, None, "right ", "missed"), main.PlannedRound(track, None, "right ", "missed")]
+    game_state.round_in_progress = True
+    main.game_registry.add(1, game_state)
+    yield game_state, sent
+    main.game_registry.discard(1)
+    main.round_scheduler.cancel(1)
+
+
+def test_a_replanned_game_stops_the_old_round_chain(game):
+    game_state, sent = game
+    stale_generation = game_state.generation
+    game_state.generation += 1  # what a second !play does before replanning
+
+    asyncio.run(main.end_round(None, game_state, stale_generation))
+
+    assert sent == []
+    assert game_state.current_round == 0
+    assert game_state.round_in_progress
+
+
+def test_the_current_round_chain_carries_on(game, monkeypatch):
+    game_state, sent = game
+    started = []
+
+    async def fake_start_round(channel, game_state, generation):
+        started.append(generation)
+
+    monkeypatch.setattr(main, "start_round", fake_start_round)
+    asyncio.run(main.end_round(None, game_state, game_state.generation))
+
+    assert sent == ["missed"]
+    assert game_state.current_round == 1
+    assert started == [game_state.generation]
+
+
+def test_a_game_between_rounds_is_not_swept(game, monkeypatch):
+    game_state, sent = game
+
+    async def fake_start_round(channel, game_state, generation):
+        pass
+
+    monkeypatch.setattr(main, "start_round", fake_start_round)
+    game_state.last_active -= main.game_registry.ttl + 1
+    asyncio.run(main.end_round(None, game_state, game_state.generation))
+
+    assert not game_state.round_in_progress
+    assert main.game_registry.sweep() == 0
+    assert main.game_registry.games[1] is game_state
@@ -0,0 +1,82 @@
+import random
+from collections import Counter
+
+import main
+
+
+def make_pool(libraries):
+    """
+    Builds a TrackPool from { player_id: [track_id, ...] }; a track listed under several players is shared.
+    """
+    pool = main.TrackPool()
+    for player_id, track_ids in libraries.items():
+        for track_id in track_ids:
+            pool.add(main.Track(track_id, f"Song {track_id}", "Artist", None), player_id)
+    return pool
+
+
+def test_small_library_gets_its_fair_share():
+    pool = make_pool({
+        "big": [f"b{i}" for i in range(200)],
+        "small": [f"s{i}" for i in range(5)],
+    })
+
+    plan = main.plan_rounds(pool, 10, random.Random(1))
+
+    owners = Counter(owner for track_id in plan for owner in pool.tracks[track_id].owner_ids)
+    assert owners["small"] == 5
+    assert owners["big"] == 5
+
+
+def test_small_library_runs_out_then_the_rest_play_on():
+    pool = make_pool({
+        "big": [f"b{i}" for i in range(200)],
+        "small": ["s0", "s1"],
+    })
+
+    plan = main.plan_rounds(pool, 10, random.Random(2))
+
+    assert len(plan) == 10
+    assert sum(track_id.startswith("s") for track_id in plan) == 2
+
+
+def test_no_track_repeats():
+    pool = make_pool({
+        "a": [f"t{i}" for i in range(0, 30)],
+        "b": [f"t{i}" for i in range(20, 50)],
+        "c": [f"t{i}" for i in range(45, 60)],
+    })
+
+    plan = main.plan_rounds(pool, 100, random.Random(3))
+
+    assert len(plan) == len(set(plan))
+    assert set(plan) == set(pool.tracks)
+
+
+def test_plan_never_exceeds_the_round_count():
+    pool = make_pool({"a": [f"a{i}" for i in range(20)], "b": [f"b{i}" for i in range(20)]})
+
+    for rounds in (0, 1, 7, 40, 100):
+        assert len(main.plan_rounds(pool, rounds, random.Random(rounds))) == min(rounds, 40)
+
+
+def test_empty_pool_plans_nothing():
+    assert main.plan_rounds(main.TrackPool(), 10, random.Random(4)) == []
+
+    # A player who joined with nothing to contribute
+    pool = main.TrackPool()
+    pool.player_tracks["a"] = set()
+    assert main.plan_rounds(pool, 10, random.Random(4)) == []
+
+
+def test_same_seed_same_plan():
+    libraries = {
+        "a": [f"t{i}" for i in range(0, 40)],
+        "b": [f"t{i}" for i in range(30, 70)],
+        "c": [f"t{i}" for i in range(65, 80)],
+    }
+
+    first = main.plan_rounds(make_pool(libraries), 25, random.Random(5))
+    second = main.plan_rounds(make_pool(libraries), 25, random.Random(5))
+
+    assert first == second
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from spotipy.exceptions import SpotifyException
+
+import main
+
+
+@pytest.fixture
+def rate_limited_api(monkeypatch):
+    """
+    A stand-in Web API that answers every request with 429 and Retry-After: 2.
+    """
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            body = b'{"error": {"status": 429, "message": "API rate limit exceeded"}}'
+            self.send_response(429)
+            self.send_header("Retry-After", "2")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(main, "SPOTIFY_API_URL", f"http://127.0.0.1:{server.server_port}/v1/")
+    yield hits
+    server.shutdown()
+    server.server_close()
+
+
+def test_rate_limit_reaches_the_scheduler_after_one_request(rate_limited_api):
+    client = main.shared_session_spotify_class()(auth="token", requests_session=main.get_spotify_session())
+    scheduler = main.SpotifyScheduler(rate=100, burst=10, per_user=2, max_retries=0)
+
+    async def call():
+        return await scheduler.request("user", client, "current_user_saved_tracks", limit=1)
+
+    with pytest.raises(SpotifyException) as excinfo:
+        asyncio.run(call())
+
+    assert excinfo.value.http_status == 429
+    assert len(rate_limited_api) == 1
+    assert scheduler.throttled == 1
+    assert scheduler.bucket.paused_until > 0
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import shutil
+import wave
+
+import pytest
+
+import main
+
+
+def make_track(track_id, preview_url=None):
+    return main.Track(track_id, f"Song {track_id}", "Artist", None, preview_url=preview_url)
+
+
+@pytest.fixture
+def preview_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "previews"
+    directory.mkdir()
+    monkeypatch.setattr(main, "PREVIEW_DIR", str(directory))
+    main.local_preview_files.cache_clear()
+    yield directory
+    main.local_preview_files.cache_clear()
+
+
+def write_pcm(directory, track_id, size):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{track_id}.pcm"), "wb") as f:
+        f.write(bytes([len(track_id)]) * size)
+
+
+def test_preview_source_prefers_the_file_named_after_the_track(preview_dir):
+    (preview_dir / "abc.mp3").write_bytes(b"")
+    (preview_dir / "other.ogg").write_bytes(b"")
+
+    assert main.preview_source(make_track("abc")) == str(preview_dir / "abc.mp3")
+
+
+def test_preview_source_maps_other_tracks_to_a_stable_local_file(preview_dir):
+    (preview_dir / "one.mp3").write_bytes(b"")
+    (preview_dir / "two.mp3").write_bytes(b"")
+
+    source = main.preview_source(make_track("xyz", preview_url="https://p.scdn.co/mp3-preview/xyz"))
+    assert source in (str(preview_dir / "one.mp3"), str(preview_dir / "two.mp3"))
+    assert main.preview_source(make_track("xyz")) == source
+
+
+def test_preview_source_without_local_files(preview_dir, monkeypatch):
+    assert main.preview_source(make_track("abc", preview_url="https://p.scdn.co/mp3-preview/abc")) is None
+
+    monkeypatch.setattr(main, "PREVIEW_DIR", None)
+    assert main.preview_source(make_track("abc", preview_url="https://p.scdn.co/mp3-preview/abc")) == "https://p.scdn.co/mp3-preview/abc"
+    assert main.preview_source(make_track("abc")) is None
+
+
+def test_clip_cache_reads_clips_cached_on_disk(tmp_path):
+    write_pcm(tmp_path, "t1", 1000)
+    cache = main.ClipCache(str(tmp_path), 10_000, 10_000)
+
+    pcm = asyncio.run(cache.get(make_track("t1")))
+
+    assert pcm == bytes([2]) * 1000
+    assert cache.fetched == 0
+    assert len(cache) == 1
+
+
+def test_clip_cache_keeps_memory_under_its_budget(tmp_path):
+    for track_id in ("t1", "t2", "t3"):
+        write_pcm(tmp_path, track_id, 1000)
+    cache = main.ClipCache(str(tmp_path), 2500, 10_000)
+
+    async def load_all():
+        for track_id in ("t1", "t2", "t3"):
+            await cache.get(make_track(track_id))
+    asyncio.run(load_all())
+
+    assert len(cache) == 2
+    assert cache.memory_used == 2000
+
+
+def test_clip_cache_shares_one_load_between_callers(tmp_path):
+    write_pcm(tmp_path, "t1", 1000)
+    cache = main.ClipCache(str(tmp_path), 10_000, 10_000)
+
+    async def load_twice():
+        return await asyncio.gather(cache.get(make_track("t1")), cache.get(make_track("t1")))
+    first, second = asyncio.run(load_twice())
+
+    assert first is second
+
+
+def test_clip_cache_without_a_preview(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "PREVIEW_DIR", None)
+    cache = main.ClipCache(str(tmp_path), 10_000, 10_000)
+
+    assert asyncio.run(cache.get(make_track("t1"))) is None
+
+
+@pytest.mark.skipif(shutil.which(main.FFMPEG) is None, reason="needs ffmpeg")
+def test_clip_cache_decodes_a_local_preview(tmp_path, preview_dir):
+    # Half a second of 48 kHz stereo silence
+    with wave.open(str(preview_dir / "t1.wav"), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(48000)
+        f.writeframes(b"\0" * 48000 * 2)
+    cache = main.ClipCache(str(tmp_path / "clips"), 10**7, 10**7)
+
+    pcm = asyncio.run(cache.get(make_track("t1")))
+
+    assert pcm is not None and len(pcm) == 48000 * 2
+    assert cache.fetched == 1